@@ -0,0 +1,75 @@
+#Measures the history file with a year of samples in it: the time per append, the file size and memory, and how long window queries take.
+#The store uses the slot counts from setup.conf, so the file is the size the monitor would use. Samples are history_interval seconds apart.
+#The file is written to a temporary directory, and the timestamps start at the current time.
+#After the fill it appends one history_flush_interval of samples and reports what the flush then writes, which is all the SD card sees in that time.
+#  python benchmarks/bench_history.py --days 365
+
+import argparse
+import asyncio
+import math
+import os
+import sys
+import tempfile
+from time import perf_counter, time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+os.chdir(repo_dir) #main.py reads setup.conf from the working directory
+
+import main
+import metrics
+
+windows = [('10 min', 600), ('1 hour', 3600), ('1 day', 86400), ('1 week', 7 * 86400), ('30 days', 30 * 86400), ('1 year', 365 * 86400)]
+
+def fill(store, start, samples): #Appends samples like the monitor's, history_interval seconds apart. Returns the slowest append in seconds
+    slowest = 0.0
+    for index in range(samples):
+        timestamp = start + index * main.history_interval
+        day = math.sin(2 * math.pi * timestamp / 86400)
+        values = [68.0 + 6 * day, 45.0 - 5 * day, 100, 1, 1]
+        append_start = perf_counter()
+        store.append(timestamp, values)
+        append_time = perf_counter() - append_start
+        if append_time > slowest:
+            slowest = append_time
+    return slowest
+
+def time_query(store, seconds, repeats): #Seconds per window() call, and the entries it returned
+    start = perf_counter()
+    for repeat in range(repeats):
+        rows = store.window('temp', seconds)
+    return ((perf_counter() - start) / repeats, len(rows))
+
+async def run(args): #Runs in a loop, since window() takes the time from the loop clock
+    samples = int(args.days * 86400 / main.history_interval)
+    start = time()
+    with tempfile.TemporaryDirectory() as data_dir:
+        path = os.path.join(data_dir, 'history.bin')
+        rss_before = metrics.process_usage()[1]
+        store = main.HistoryStore(path, main.history_raw_slots, main.history_minute_slots, main.history_hour_slots)
+        slowest = fill(store, start, samples)
+        flush_start = perf_counter()
+        store.flush()
+        flush_time = perf_counter() - flush_start
+        rss_after = metrics.process_usage()[1]
+        interval_samples = main.history_flush_interval // main.history_interval
+        fill(store, start + samples * main.history_interval, interval_samples)
+        changes = store.changes()
+        write_start = perf_counter()
+        store.write(changes)
+        write_time = perf_counter() - write_start
+        print(str(samples) + ' samples (' + str(args.days) + ' days at ' + str(main.history_interval) + ' s)')
+        print('Append: ' + str(round(store.average_append() * 1000000, 1)) + ' us average, ' + str(round(slowest * 1000000, 1)) + ' us slowest | Flush: ' + str(round(flush_time * 1000, 1)) + ' ms')
+        print('File: ' + str(round(os.path.getsize(path) / 1024 / 1024, 2)) + ' MB | RSS grew ' + str(round((rss_after - rss_before) / 1024 / 1024, 2)) + ' MB')
+        print('Flush after ' + str(main.history_flush_interval) + ' s of samples: ' + str(sum(len(data) for offset, data in changes)) + ' bytes in ' + str(len(changes)) + ' writes, ' + str(round(write_time * 1000, 1)) + ' ms')
+        main.wall_clock_offset = start + (samples + interval_samples - 1) * main.history_interval - asyncio.get_running_loop().time() #now() is the time of the last sample
+        print('Window      Entries   Per query')
+        for name, seconds in windows:
+            query_time, entries = time_query(store, seconds, args.repeats)
+            print(name.ljust(10) + str(entries).rjust(9) + (str(round(query_time * 1000, 3)) + ' ms').rjust(12))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure appends and queries on a year of history.')
+    parser.add_argument('--days', type=float, default=365, help='Days of samples to append')
+    parser.add_argument('--repeats', type=int, default=20, help='Times to run each query')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,216 @@
+#Measures the idle CPU and memory of the monitor against the multiprocess layout it replaced.
+#Both run on the simulated devices for the same time and are measured over their whole process tree from /proc, so this only runs on Linux.
+#The multiprocess layout is rebuilt below from the old main.py: seven processes sharing multiprocessing Values, with check_button, pon_caller and the parent busy waiting.
+#Memory is PSS, so pages shared between the forked processes are only counted once.
+#  python benchmarks/bench_idle.py --seconds 30
+
+import argparse
+import configparser
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+from time import sleep, time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import devices
+
+#The multiprocess layout. Each worker is the old one with the hardware swapped for a simulated device. The intervals are the old setup.conf defaults
+
+def update_values(temp, humid):
+    dht = devices.ScriptedDHT()
+    while True:
+        temp.value = 1.8 * dht.temperature + 32 #get_temp and get_humid each read the sensor
+        humid.value = dht.humidity
+        sleep(1)
+
+def output_values(temp, humid, screen, display):
+    lcd = devices.RecordingLCD()
+    while True:
+        if display.value == 1:
+            for row, line in enumerate(['Temp: ' + str(round(temp.value, 1)) + ' F', 'Hmd: ' + str(round(humid.value, 1)) + ' rH']): #lcd.text rewrote both whole lines every second
+                lcd.write(0x80 + 0x40 * row, 0)
+                for character in line.ljust(16):
+                    lcd.write(ord(character), 1)
+            print('Temp: ' + str(round(temp.value, 1)) + ' F | Humidity: ' + str(round(humid.value, 1)) + ' rH')
+        sleep(1)
+
+def check_conn(conn):
+    while True:
+        comm = os.popen('ip a|grep ppp0').read()
+        if comm == '':
+            try:
+                socket.setdefaulttimeout(3)
+                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                s.connect(('127.0.0.1', 9))
+            except OSError:
+                conn.value = 0
+            else:
+                s.close()
+                conn.value = 1
+        sleep(20)
+
+def check_power(pwr_status, bat_cap):
+    ups = devices.FakeUPS()
+    while True:
+        ups.send(True, 100)
+        serial_data = str(ups.read(ups.in_waiting)).split(',')
+        pwr_status.value = int('GOOD' in serial_data[1])
+        bat_cap.value = int(serial_data[2].replace('BATCAP ', ''))
+        sleep(1)
+
+class IdleButton: #Button that is never pressed
+    is_active = False
+
+def check_button(screen, display):
+    button = IdleButton()
+    while True: #Spins while the button isn't pressed, like the old check_button
+        start_time = time()
+        diff = 0
+        while button.is_active and diff < 3:
+            diff = time() - start_time
+        if diff < 3 and diff != 0:
+            screen.value = (screen.value + 1) % 3
+            sleep(.5)
+
+def monitor_values(temp, humid, conn, pwr_status):
+    counts = [0, 0, 0, 0]
+    while True:
+        checks = [53.0 <= temp.value <= 75.1, 40.0 <= humid.value <= 60.1, conn.value == 1, pwr_status.value == 1]
+        for index, passed in enumerate(checks):
+            if not passed:
+                counts[index] += 1
+            elif counts[index] > 0:
+                counts[index] = 0
+        sleep(5)
+
+def pon_caller(pon_function):
+    while True: #Spins waiting for pon_function, like the old pon_caller
+        if pon_function.value == 1:
+            pon_function.value = 0
+
+def multiprocess_layout(): #Starts the seven workers and busy waits in the parent, like the old main.py
+    context = multiprocessing.get_context('fork')
+    temp = context.Value('f', 0.0)
+    humid = context.Value('f', 0.0)
+    bat_cap = context.Value('i', 0)
+    conn = context.Value('i', 0)
+    pwr_status = context.Value('i', 0)
+    pon_function = context.Value('i', 0)
+    screen = context.Value('i', 0)
+    display = context.Value('i', 1)
+    workers = [context.Process(target=update_values, args=(temp, humid)),
+               context.Process(target=output_values, args=(temp, humid, screen, display)),
+               context.Process(target=check_conn, args=(conn,)),
+               context.Process(target=check_power, args=(pwr_status, bat_cap)),
+               context.Process(target=check_button, args=(screen, display)),
+               context.Process(target=monitor_values, args=(temp, humid, conn, pwr_status)),
+               context.Process(target=pon_caller, args=(pon_function,))]
+    for worker in workers:
+        worker.start()
+    while True:
+        pass
+
+#Measuring a process tree from /proc
+
+def process_tree(pid): #pid and every process descended from it
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split() #The process name can contain spaces, so fields are counted from the ')' after it
+        except OSError: #Process exited while listing
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, []))
+    return tree
+
+def cpu_seconds(pids): #CPU seconds used by each process, by pid
+    ticks = os.sysconf('SC_CLK_TCK')
+    usage = {}
+    for pid in pids:
+        try:
+            with open('/proc/' + str(pid) + '/stat') as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        usage[pid] = (int(fields[11]) + int(fields[12])) / ticks #utime and stime
+    return usage
+
+def memory_kb(pids): #Proportional set size of the processes, falling back to RSS on kernels without smaps_rollup
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/' + str(pid) + '/smaps_rollup') as smaps:
+                key = 'Pss:'
+                lines = smaps.readlines()
+        except OSError:
+            try:
+                with open('/proc/' + str(pid) + '/status') as status:
+                    key = 'VmRSS:'
+                    lines = status.readlines()
+            except OSError:
+                continue
+        for line in lines:
+            if line.startswith(key):
+                total += int(line.split()[1])
+                break
+    return total
+
+def measure(command, cwd, warmup, seconds): #Runs a command, lets it settle and measures its process tree. Returns (CPU percent of one core, memory in kB, process count)
+    process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL, start_new_session=True)
+    try:
+        sleep(warmup)
+        start = cpu_seconds(process_tree(process.pid))
+        sleep(seconds)
+        pids = process_tree(process.pid)
+        end = cpu_seconds(pids)
+        used = sum(end[pid] - start.get(pid, 0.0) for pid in end)
+        memory = memory_kb(pids)
+    finally:
+        os.killpg(process.pid, signal.SIGTERM) #Stops the workers as well. The monitor shuts down cleanly on SIGTERM
+        process.wait()
+    return (100 * used / seconds, memory, len(pids))
+
+def monitor_config(data_dir): #Copy of setup.conf that runs the monitor on the simulated devices, keeping its files in data_dir
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(os.path.join(repo_dir, 'setup.conf'))
+    config.set('general', 'simulate', 'True')
+    config.set('general', 'debug', 'True')
+    config.set('general', 'metrics_port', '0')
+    config.set('general', 'alert_journal', os.path.join(data_dir, 'alert_journal.json'))
+    config.set('monitor', 'history_file', os.path.join(data_dir, 'history.bin'))
+    config.set('monitor', 'check_targets', "[('127.0.0.1', 9)]") #Refused right away, so the benchmark doesn't depend on the network
+    with open(os.path.join(data_dir, 'setup.conf'), 'w') as config_file:
+        config.write(config_file)
+
+def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        monitor_config(data_dir)
+        results.append(('asyncio', measure([sys.executable, os.path.join(repo_dir, 'main.py')], data_dir, args.warmup, args.seconds)))
+    results.append(('multiprocess', measure([sys.executable, os.path.abspath(__file__), '--multiprocess-layout'], repo_dir, args.warmup, args.seconds)))
+    print('Idle for ' + str(args.seconds) + ' s on ' + str(os.cpu_count()) + ' cores')
+    print('Layout        CPU (% of a core)  Memory (PSS)  Processes')
+    for name, (cpu, memory, processes) in results:
+        print(name.ljust(14) + str(round(cpu, 1)).rjust(17) + (str(round(memory / 1024, 1)) + ' MB').rjust(14) + str(processes).rjust(11))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the idle CPU and memory of the monitor with the old multiprocess layout.')
+    parser.add_argument('--seconds', type=float, default=20, help='Seconds to measure each layout for')
+    parser.add_argument('--warmup', type=float, default=3, help='Seconds to let each layout start before measuring')
+    parser.add_argument('--multiprocess-layout', action='store_true', help=argparse.SUPPRESS) #Used by run() to start the old layout in its own process
+    args = parser.parse_args()
+    if args.multiprocess_layout:
+        multiprocess_layout()
+    else:
+        run(args)
@@ -0,0 +1,65 @@
+#Measures the LCD bus traffic of the renderer against the full two-line rewrite it replaced, on the same state changes.
+#The state follows the replay's synthetic trace, and the screen is cycled every --screen-every seconds like someone pressing the button.
+#Old timer is the old output_values: lcd.text rewrote both whole lines every second. Old on change only rewrites both lines when they change,
+#which shows how much comes from not redrawing and how much from only writing the changed characters. New is LCDRenderer on request_render().
+#Bytes are counted on a RecordingLCD, one per command or character, so cursor moves count the same as characters.
+#  python benchmarks/bench_lcd.py --days 3
+
+import argparse
+import os
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+os.chdir(repo_dir) #main.py reads setup.conf from the working directory
+
+import devices
+import main
+import replay
+
+def full_rewrite(lcd, lines): #What rpi_lcd's lcd.text did for each line: a cursor move, then the whole line padded to the width
+    for row, address in enumerate(main.lcd_line_addresses):
+        lcd.write(address, 0)
+        for character in lines[row][:main.lcd_width].ljust(main.lcd_width):
+            lcd.write(ord(character), 1)
+
+def run(args):
+    rows = replay.synthetic_trace(args.days, args.step, args.seed)
+    main.state = main.MonitorState()
+    timer_lcd = devices.RecordingLCD()
+    change_lcd = devices.RecordingLCD()
+    renderer = main.LCDRenderer(devices.RecordingLCD())
+    last_lines = None
+    changes = 0
+    for second in range(int(args.days * 86400)):
+        if second % args.step == 0: #New trace row
+            row = rows[second // args.step]
+            main.state.temp = row['temp_f']
+            main.state.humid = row['humid']
+            main.state.pwr_status = row['vin_good']
+            main.state.bat_cap = row['batcap']
+            main.state.conn_status = row['conn']
+            main.state.conn = int(row['conn'] != 'disconnected')
+        if second % args.screen_every == 0 and second > 0:
+            main.state.screen = (main.state.screen + 1) % len(main.screen_templates)
+        lines = main.screen_lines()
+        full_rewrite(timer_lcd, lines)
+        if lines != last_lines: #Same test request_render() makes
+            changes += 1
+            full_rewrite(change_lcd, lines)
+            renderer.render(lines)
+            last_lines = lines
+    seconds = args.days * 86400
+    print(str(args.days) + ' days, ' + str(changes) + ' screen changes')
+    print('Rewrite              Bytes   Bytes/hour')
+    for name, written in (('Old timer', timer_lcd.bytes_written), ('Old on change', change_lcd.bytes_written), ('New', renderer.bytes_written)):
+        print(name.ljust(14) + str(written).rjust(12) + str(round(written / seconds * 3600)).rjust(13))
+    print('New writes ' + str(round(100 * renderer.bytes_written / timer_lcd.bytes_written, 2)) + '% of the old traffic')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare LCD bus traffic of the renderer and the old full rewrite.')
+    parser.add_argument('--days', type=float, default=3, help='Length of the synthetic trace in days')
+    parser.add_argument('--step', type=int, default=10, help='Seconds between rows of the synthetic trace')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the synthetic trace')
+    parser.add_argument('--screen-every', type=int, default=600, help='Seconds between button presses that change the screen')
+    run(parser.parse_args())
@@ -0,0 +1,51 @@
+#Measures what one connectivity probe costs, in CPU time and wall time, against local listener sockets.
+#Run it on the Pi to see how much of its CPU the probes take at up_conn_interval.
+#  python benchmarks/bench_probe.py --cycles 500
+
+import argparse
+import asyncio
+import os
+import socket
+import sys
+from time import perf_counter
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+os.chdir(repo_dir) #main.py reads setup.conf from the working directory
+
+import main
+
+def closed_target(): #Port nothing listens on, so connecting is refused right away
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return ('127.0.0.1', sock.getsockname()[1])
+
+async def measure(up, down, cycles): #Probes up listening and down refusing targets cycles times. Returns (CPU ms per probe, wall ms per probe, status)
+    servers = []
+    targets = []
+    for index in range(up):
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+        servers.append(server)
+        targets.append(('127.0.0.1', server.sockets[0].getsockname()[1]))
+    targets.extend(closed_target() for index in range(down))
+    prober = main.ConnProber(targets, 1, main.check_timeout, main.check_degraded_rtt, main.check_history)
+    start = perf_counter()
+    for cycle in range(cycles):
+        status = await prober.probe()
+    wall = perf_counter() - start
+    for server in servers:
+        server.close()
+    return (prober.average_cost() * 1000, wall / cycles * 1000, status)
+
+def run(args):
+    print('Targets (up/down)  CPU per probe  Wall per probe  Status')
+    results = {}
+    for up, down in ((1, 0), (2, 0), (2, 1), (8, 0)):
+        cpu, wall, status = results[(up, down)] = asyncio.run(measure(up, down, args.cycles))
+        print((str(up) + '/' + str(down)).ljust(18) + (str(round(cpu, 3)) + ' ms').rjust(13) + (str(round(wall, 3)) + ' ms').rjust(16) + '  ' + status)
+    print('At up_conn_interval = ' + str(main.up_conn_interval) + ' s, a 2 target probe uses ' + str(round(results[(2, 0)][0] / main.up_conn_interval / 10, 5)) + '% of a core')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the cost of one connectivity probe.')
+    parser.add_argument('--cycles', type=int, default=200, help='Probes to run for each set of targets')
+    run(parser.parse_args())
@@ -0,0 +1,57 @@
+#Measures how the rule engine scales with the number of rules: the time to read and check them when the config is loaded, and the time per evaluate().
+#Half of the rules are range rules and half are bool rules, spread over the metrics. Half of them fail, so the sustain bookkeeping is run as well.
+#Rate rules are left out, since each one reads the history rather than the snapshot.
+#  python benchmarks/bench_rules.py --checks 200
+
+import argparse
+import configparser
+import os
+import sys
+from time import perf_counter
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+os.chdir(repo_dir) #main.py reads setup.conf from the working directory
+
+import main
+
+range_metrics = ['temp', 'humid', 'bat_cap']
+bool_metrics = ['conn', 'pwr_status']
+
+def rules_config(count): #Config with count rules in it
+    config = configparser.ConfigParser(interpolation=None)
+    for index in range(count):
+        if index % 2 == 0:
+            metric = range_metrics[index // 2 % len(range_metrics)]
+            options = {'metric' : metric, 'condition' : 'range', 'low' : str(index % 100), 'high' : str(50 + index % 100), 'hysteresis' : '1'}
+        else:
+            options = {'metric' : bool_metrics[index // 2 % len(bool_metrics)], 'condition' : 'bool', 'placeholder' : 'bat_cap'}
+        options['sustain'] = str(index % 3 * 30)
+        options['message'] = 'Rule ' + str(index) + ' at _PLACEHOLDER_'
+        config['rule ' + str(index)] = options
+    return config
+
+def measure(count, checks): #Returns (ms to load the rules, us per evaluate)
+    config = rules_config(count)
+    start = perf_counter()
+    engine = main.load_rules(config)
+    load_time = perf_counter() - start
+    state = main.MonitorState()
+    state.pwr_status = 0
+    snapshot = vars(state)
+    start = perf_counter()
+    for check in range(checks):
+        engine.evaluate(snapshot, check * main.monitor_interval)
+    return (load_time * 1000, (perf_counter() - start) / checks * 1000000)
+
+def run(args):
+    print('Rules      Load   Per evaluate   Per rule')
+    for count in (10, 100, 1000, 5000):
+        load_time, evaluate_time = measure(count, args.checks)
+        print(str(count).ljust(6) + (str(round(load_time, 1)) + ' ms').rjust(10) + (str(round(evaluate_time, 1)) + ' us').rjust(15) + (str(round(evaluate_time / count * 1000)) + ' ns').rjust(11))
+    print('At monitor_interval = ' + str(main.monitor_interval) + ' s, 5000 rules use ' + str(round(evaluate_time / main.monitor_interval / 10000, 4)) + '% of a core')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure rule loading and evaluation with thousands of rules.')
+    parser.add_argument('--checks', type=int, default=200, help='Times to evaluate each set of rules')
+    run(parser.parse_args())
@@ -0,0 +1,69 @@
+#Measures how fast UPSParser.feed parses the UPS stream, for reads of different sizes, and compares it with what the serial line can deliver.
+#The UPS is on a 9600 baud line, so it can send at most 960 bytes a second. Reads of 1 byte are the worst case, where every byte arrives on its own.
+#With --pty the frames also go through a pseudo terminal from devices.PtyUPS, so the kernel's tty layer is counted as well.
+#  python benchmarks/bench_ups.py --frames 50000 --pty
+
+import argparse
+import asyncio
+import os
+import sys
+from time import perf_counter, process_time
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+os.chdir(repo_dir) #main.py reads setup.conf from the working directory
+
+import devices
+import main
+
+line_rate = 9600 // 10 #Bytes a second at 9600 baud, with a start and stop bit around every byte
+
+def stream(frames): #Frames like the UPS sends, with the battery draining and power coming and going
+    return b''.join(devices.ups_frame(index % 50 != 0, 100 - index % 100, 5000 + index % 500) for index in range(frames))
+
+def feed_chunks(data, chunk): #Feeds data to a new parser chunk bytes at a time. Returns (CPU seconds, parser)
+    parser = main.UPSParser(main.ups_history)
+    start = process_time()
+    for offset in range(0, len(data), chunk):
+        parser.feed(data[offset:offset + chunk])
+    return (process_time() - start, parser)
+
+def feed_pty(data, chunk): #Writes data to a PtyUPS and feeds what comes out of the other end to a new parser. Returns (wall seconds, parser)
+    ups = devices.PtyUPS()
+    parser = main.UPSParser(main.ups_history)
+    start = perf_counter()
+    try:
+        for offset in range(0, len(data), chunk): #Reads everything back after each write, so the pty buffer never fills up
+            ups.write(data[offset:offset + chunk])
+            waiting = min(chunk, len(data) - offset)
+            while waiting > 0:
+                read = os.read(ups.slave, waiting)
+                parser.feed(read)
+                waiting -= len(read)
+    finally:
+        ups.close()
+    return (perf_counter() - start, parser)
+
+def report(name, data, seconds, parser):
+    print(name.ljust(22) + (str(round(len(data) / seconds / 1e6, 2)) + ' MB/s').rjust(12) + (str(round(parser.frames / seconds)) + ' frames/s').rjust(18) + (str(round(len(data) / seconds / line_rate)) + 'x').rjust(12))
+    if parser.frame_errors != 0:
+        print('  ' + str(parser.frame_errors) + ' frames were not parsed')
+
+async def run(args): #Runs in a loop because the parser timestamps frames with the loop clock
+    data = stream(args.frames)
+    print(str(args.frames) + ' frames, ' + str(len(data)) + ' bytes, ' + str(round(len(data) / args.frames)) + ' bytes a frame')
+    print('Reads                   Throughput            Frames   Line rate')
+    for chunk in (1, 16, 64, line_rate, 65536):
+        seconds, parser = feed_chunks(data, chunk)
+        report(str(chunk) + ' bytes', data, seconds, parser)
+    if args.pty:
+        seconds, parser = feed_pty(data, line_rate)
+        report('pty, ' + str(line_rate) + ' bytes', data, seconds, parser)
+    seconds, parser = feed_chunks(data, 1)
+    print('Parsing a full line rate of 1 byte reads uses ' + str(round(100 * seconds * line_rate / len(data), 4)) + '% of a core')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the throughput of the UPS stream parser.')
+    parser.add_argument('--frames', type=int, default=20000, help='Frames in the test stream')
+    parser.add_argument('--pty', action='store_true', help='Also send the stream through a pseudo terminal')
+    asyncio.run(run(parser.parse_args()))
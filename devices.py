@@ -0,0 +1,163 @@
+#Devices used by the monitor: DHT (Sensor), LCD, Button, UPS and the SMS client.
+#The real drivers are only imported when they are opened, so the monitor can be imported, tested and profiled off a Raspberry Pi using the simulated devices below.
+
+import importlib
+import os
+import threading
+import tty
+from time import time
+
+class Devices: #Holds one of each device. The monitor only uses the attributes and methods the simulated devices below also have
+    def __init__(self, dht, lcd, button, ups, sms):
+        self.dht = dht #Has temperature (celsius) and humidity properties
+        self.lcd = lcd #Has write(byte, mode) and clear()
+        self.button = button #Has when_held and when_released callbacks
+        self.ups = ups #Has in_waiting and read(size)
+        self.sms = sms #Has messages.create(body, from_, to)
+
+class LazyDevice: #Opens a device the first time it is used instead of at startup
+    def __init__(self, opener):
+        self._opener = opener
+        self._device = None
+        self._lock = threading.Lock() #The first alert uses the SMS client from several executor threads at once, and they all have to get the same client
+
+    def __getattr__(self, name): #Only called for attributes LazyDevice doesn't have itself, so every device attribute goes through here
+        if self._device == None:
+            with self._lock:
+                if self._device == None: #Another thread may have opened it while this one waited
+                    self._device = self._opener()
+        return getattr(self._device, name)
+
+def open_twilio(account_sid, auth_token): #The Twilio SDK is slow to import, so it is only loaded when the first message is sent
+    return importlib.import_module('twilio.rest').Client(account_sid, auth_token)
+
+def open_button(pin=4, hold_time=3): #Opens the button. bounce_time debounces the contacts. hold_time is how long to hold the button before toggling the display value
+    #Set the GPIOZERO_PIN_FACTORY environment variable to 'mock' to run without the hardware button. Presses can then be simulated with button.pin.drive_low() and drive_high()
+    from gpiozero import Button
+    return Button(pin, bounce_time=0.05, hold_time=hold_time)
+
+def open_real_devices(config): #Opens the hardware. By default the DHT22 is on GPIO 17, the button is on GPIO 4, the LCD is on I2C and the UPS is on serial
+    import adafruit_dht
+    from rpi_lcd import LCD
+    import serial
+
+    dht = adafruit_dht.DHT22(17)
+    lcd = LCD()
+    button = open_button()
+    ups = serial.Serial(
+        port=config.get('monitor', 'ups_port'), #Can be pointed at a pty to stand in for the UPS
+        baudrate= 9600,
+        parity=serial.PARITY_NONE,
+        stopbits=serial.STOPBITS_ONE,
+        bytesize=serial.EIGHTBITS,
+        timeout=0) #Reads never block. The UPS streams continuously, so every check drains whatever has arrived
+    sms = LazyDevice(lambda: open_twilio(config.get('twilio', 'account_sid'), config.get('twilio', 'auth_token'))) #Values can be found when viewing the Messenging account details
+    return Devices(dht, lcd, button, ups, sms)
+
+#Simulated devices. Used by replay.py, and by the monitor itself when simulate is set to True in the config.
+
+class ScriptedDHT: #Stands in for the DHT22. Returns the last reading given to set(), or fails like the real sensor does
+    def __init__(self, celsius=20.0, humidity=45.0):
+        self.set(celsius, humidity)
+
+    def set(self, celsius, humidity, failing=False): #Sets the next reading. failing makes reads raise the checksum error the real sensor throws
+        self.celsius = celsius
+        self.humidity_value = humidity
+        self.failing = failing
+
+    @property
+    def temperature(self):
+        if self.failing:
+            raise RuntimeError('Checksum did not validate. Try again.')
+        return self.celsius
+
+    @property
+    def humidity(self):
+        if self.failing:
+            raise RuntimeError('Checksum did not validate. Try again.')
+        return self.humidity_value
+
+def ups_frame(vin_good, batcap, vout=5250): #One frame in the format the UPS sends
+    if vin_good:
+        vin = 'GOOD'
+    else:
+        vin = 'NG'
+    return ('$ SmartUPS V3.2P,Vin ' + vin + ',BATCAP ' + str(batcap) + ',Vout ' + str(vout) + ' $\n').encode('ascii')
+
+class FakeUPS: #Stands in for the UPS serial port. Frames added with send() are read back the same way as the real stream
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def send(self, vin_good, batcap, vout=5250): #Adds one frame to the stream
+        self.buffer += ups_frame(vin_good, batcap, vout)
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def read(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+class PtyUPS: #Fake UPS on a pseudo terminal, for running the real serial driver without the UPS. Point ups_port at port, then send() writes frames to it
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave) #No echo or newline translation, like a real serial line
+        self.port = os.ttyname(self.slave)
+
+    def send(self, vin_good, batcap, vout=5250): #Writes one frame. Blocks once the pty buffer is full and nothing is reading
+        self.write(ups_frame(vin_good, batcap, vout))
+
+    def write(self, data): #Writes raw bytes, for garbled or split frames
+        os.write(self.master, data)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+class VirtualButton: #Stands in for the gpiozero button. press() and hold() call the same callbacks the real button would
+    def __init__(self):
+        self.when_held = None
+        self.when_released = None
+
+    def press(self): #A short press
+        if self.when_released != None:
+            self.when_released()
+
+    def hold(self): #Held for hold_time and then let go
+        if self.when_held != None:
+            self.when_held()
+        self.press()
+
+class RecordingLCD: #Stands in for the LCD. Counts every byte written so the bus traffic can be measured
+    def __init__(self):
+        self.bytes_written = 0
+        self.clears = 0
+        self.cursor = 0 #Address the next character is written to
+        self.screen = {} #Character at each address, so what is on the panel can be checked
+
+    def write(self, byte, mode=0): #mode 0 is a command, 1 is a character
+        self.bytes_written += 1
+        if mode == 0 and byte & 0x80: #Cursor move command
+            self.cursor = byte & 0x7F
+        elif mode == 1:
+            self.screen[self.cursor] = chr(byte)
+            self.cursor += 1
+
+    def clear(self):
+        self.bytes_written += 1
+        self.clears += 1
+        self.screen = {}
+
+class FakeSMS: #Stands in for the Twilio client. Keeps every message instead of sending it
+    def __init__(self, clock=time):
+        self.clock = clock #Used to timestamp the messages. The replay harness passes the monitor's clock so the times follow the replay
+        self.messages = self #So messages.create() works like the Twilio client
+        self.sent = [] #(time, to, body) for every message
+
+    def create(self, body, from_, to):
+        self.sent.append((self.clock(), to, body))
+
+def open_simulated_devices(clock=time): #Opens a full set of simulated devices
+    return Devices(ScriptedDHT(), RecordingLCD(), VirtualButton(), FakeUPS(), FakeSMS(clock))
@@ -1,341 +1,1227 @@
-import adafruit_dht
-from time import sleep, time
-from sys import exit
-from rpi_lcd import LCD
-from gpiozero import Button
-import multiprocessing
-import serial
-from twilio.rest import Client
+from time import perf_counter
+start_time = perf_counter() #Used to report how long startup took
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from statistics import median
+from time import process_time, time
+import resource
+import json
+import ast
+import shlex
+from array import array
 import os
-import socket
 import signal
+import traceback
 import configparser
+import devices
+import metrics
 
-config = configparser.ConfigParser()
+config = configparser.ConfigParser(interpolation=None) #No interpolation, so messages can use % signs
 config.read('setup.conf')
 
-#Initializing devices. DHT (Sensor), LCD, Button, UPS
-
-dht_device = adafruit_dht.DHT22(17)
-lcd = LCD()
-button = Button(4)
+#Devices. DHT (Sensor), LCD, Button, UPS and the SMS client. Opened by setup() rather than on import, so the monitor can be imported and run off a Raspberry Pi with simulated devices.
 
-ups = serial.Serial(
-    port='/dev/ttyAMA0',
-    baudrate= 9600,
-    parity=serial.PARITY_NONE,
-    stopbits=serial.STOPBITS_ONE,
-    bytesize=serial.EIGHTBITS,
-    timeout=3)
+hw = None
+dht_sampler = None #These are created by setup(), since they use the devices or open files
+lcd_renderer = None
+history = None
+alert_queue = None
 
-#Initializing multiprocessing variables and setting them to default values.
+#Initializing the shared monitor state.
+#Every task runs on one asyncio loop in one process, so the values are plain attributes on a single state object instead of multiprocessing values.
 #These defaults will ensure that the monitor is not triggered until a real data value is received.
 
-temp = multiprocessing.Value('f', 0.0) #Float
-humid = multiprocessing.Value('f', 0.0) #Float
-bat_cap = multiprocessing.Value('i', 0) #Integer
-conn = multiprocessing.Value('i', 0) #Integer, used as a boolean
-pwr_status = multiprocessing.Value('i', 0) #Integer, used as a boolean
-pon_function = multiprocessing.Value('i', 0) #Integer, used as a boolean
+class MonitorState:
+    def __init__(self):
+        self.temp = 65.0 #Measured in degrees Fahrenheit
+        self.humid = 50.0 #Measured in rH
+        self.bat_cap = 100 #Percent out of 100, UPS battery capacity
+        self.conn = 1 #Used for internet connection. 1 is connected, 0 is disconnected
+        self.conn_status = 'connected' #More detail on the internet connection. 'connected', 'degraded' (slow or some targets failing, but conn is still 1) or 'disconnected'
+        self.pwr_status = 1 #Used for external power. 1 is connected, 0 is disconnected.
 
-temp.value = 65.0 #Measured in degrees Fahrenheit
-humid.value = 50 #Measured in rH
-bat_cap.value = 100 #Percent out of 100, UPS battery capacity
-conn.value = 1 #Used for internet connection. 1 is connected, 0 is disconnected
-pwr_status.value = 1 #Used for external power. 1 is connected, 0 is disconnected.
-pon_function.value = 0 #Used to start pon, for connecting to internet over sim. Setting to 1 calls the function to start.
+        self.screen = 0 #Used to track the screen that the LCD is displaying
+        self.display = 1 #Tracks whether to load the LCD screen. 1 is on, 0 is off.
+        self.button_held = False #Set when the current press has been held long enough to toggle the display, so releasing it does not also change the screen
 
-screen = multiprocessing.Value('i', 0) #Integer
-display = multiprocessing.Value('i', 0) #Integer, used as boolean.
+state = MonitorState()
 
-screen.value = 0 #Used to track the screen that the LCD is displaying
-display.value = 1 #Tracks whether to load the LCD screen. 1 is on, 0 is off.
+executor = ThreadPoolExecutor(max_workers=6) #Small thread pool for the blocking drivers (DHT, UPS serial, Twilio) so they never stall the event loop. Alerts to each phone number are sent in parallel, so it has a few more threads than drivers
 
 #Initializing program constants.
 
-screen_list = [0, 1, 2] #Possible screens. 0 is Temp/Humidity. 1 is Internet. 2 is Power
+screen_templates = [('Temp: {temp:.1f} F', 'Hmd: {humid:.1f} rH'), #Temp/Humidity
+                    ('Internet Status:', '{conn_text}'), #Internet
+                    ('PWR Status: {pwr_text}', 'Battery: {bat_cap}%')] #Power
+#LCD screens, one pair of lines each. The fields in braces are filled in by screen_values()
+
+screen_list = list(range(len(screen_templates))) #Possible screens. 0 is Temp/Humidity. 1 is Internet. 2 is Power
+
+lcd_width = 16 #Characters per line on the LCD
+lcd_line_addresses = [0x80, 0xC0] #HD44780 commands that move the cursor to the start of each line
 
-hold_time = 3 #How long to hold the button before toggling the display value
 
-account_sid = config.get('twilio', 'account_sid') #Used for Twilio messenger. Values can be found when viewing the Messenging account details
-auth_token = config.get('twilio', 'auth_token')
-Client = Client(account_sid, auth_token)
 messenger_number = config.get('twilio', 'messenger_number') #Phone number for Twilio messenger
 
-check_conn_host = config.get('monitor', 'check_ip') #Host IP and port to be used when testing connection to the internet.
-check_conn_port = int(config.get('monitor', 'check_port'))
+check_targets = ast.literal_eval(config.get('monitor', 'check_targets')) #List of (host, port) pairs used when testing connection to the internet. Each one is tried at the same time
+check_quorum = int(config.get('monitor', 'check_quorum')) #How many targets have to connect for the internet to count as connected
+check_timeout = float(config.get('monitor', 'check_timeout')) #Seconds to wait for each target to connect
+check_degraded_rtt = float(config.get('monitor', 'check_degraded_rtt')) #Average round trip time in milliseconds above which the connection counts as degraded
+check_history = int(config.get('monitor', 'check_history')) #How many round trip times to keep per target for the rolling average
 
 location = config.get('general', 'location') #Location to announce when sending messages.
-alert_list = config.get('general', 'alert_list') #List of phone numbers to send alerts to
-message_dict = {'temp_hot' : 'Room temperature is too hot.\nCurrent Temperature: _PLACEHOLDER_ F',
-                'temp_cold' : 'Room temperature is too cold.\nCurrent Temperature: _PLACEHOLDER_ F',
-                'humid_high' : 'Room humidity is too high.\nCurrent Value: _PLACEHOLDER_ rH',
-                'humid_low' : 'Room humidity is too low.\nCurrent Value: _PLACEHOLDER_ rH',
-                'internet' : 'Internet connection status:\nDisconnected',
-                'power' : 'External power unavailable.\nServer Monitor UPS Capacity: _PLACEHOLDER_%'
-                } #Specific alert messages. Header is added in the message function, and the _PLACEHOLDER_ is filled in with multiprocessing values
-
-debug = config.get('general', 'debug') #If this is set to true, the program will not actually send messages or start pon. Instead, messages will be displayed in terminal.
-
-check_value_dict = {'temp' : [0,'range', float(config.get('monitor', 'temp_lowest')), float(config.get('monitor', 'temp_highest'))],
-                    'humid' : [0, 'range', float(config.get('monitor', 'humidity_lowest')), float(config.get('monitor', 'humidity_highest'))],
-                    'internet' : [0, 'bool'],
-                    'power' : [0, 'bool']} #Dictionary used when monitoring values. A message is only sent after a value has been checked and failed three times.
-#[0] counts how many times the value has been checked and failed, meaning a message will be sent after it reaches value 2
-#[1] specifies the type of value it is. Temp and humid are integers that have to stay between a range and internet and power are booleans that have to be 1
-#[2] and [3] are only included if the value is a range. [2] is the start of the range and [3] is the end. For example, temperature has to stay between 53.0 and 75.1 degrees F
-
-minute_interval = int(config.get('monitor', 'minute_interval')) #How many minutes to wait between sending a warning message for the same monitored value.
+alert_list = ast.literal_eval(config.get('general', 'alert_list')) #List of phone numbers to send alerts to. Parsed into a real list, not left as the string from the config
+alert_journal = config.get('general', 'alert_journal') #File that alerts waiting to be sent are saved to, so they survive a restart
+alert_queue_size = int(config.get('general', 'alert_queue_size')) #Most alerts that can wait to be sent, not counting the one being sent. When full, the oldest waiting alert is dropped
+alert_retries = int(config.get('general', 'alert_retries')) #How many times to retry sending an alert to the phone numbers that failed
+alert_retry_delay = int(config.get('general', 'alert_retry_delay')) #Seconds to wait before the first retry. Doubles after every retry
+alert_digest_window = int(config.get('general', 'alert_digest_window')) #Seconds to collect alerts before sending them together as one message
+
+link_interface_dir = config.get('general', 'link_interface_dir') #Directory the ppp0 interface shows up in when the SIM connection is up
+pon_command = config.get('general', 'pon_command') #Commands used to bring the SIM connection up and take it down
+poff_command = config.get('general', 'poff_command')
+link_up_timeout = int(config.get('general', 'link_up_timeout')) #Seconds to wait for ppp0 to come up after running pon
+link_idle_timeout = int(config.get('general', 'link_idle_timeout')) #Seconds to keep the SIM connection up after the last alert is sent, in case another one is queued
+
+simulate = config.getboolean('general', 'simulate') #If this is set to true, the monitor runs on simulated devices instead of the hardware
+
+metrics_host = config.get('general', 'metrics_host') #Address the metrics endpoint listens on. 127.0.0.1 keeps it local to the Pi
+metrics_port = int(config.get('general', 'metrics_port')) #Port the metrics endpoint listens on. 0 turns it off
+profile_interval = int(config.get('general', 'profile_interval')) #Milliseconds of CPU time between profiler samples. 0 turns the profiler off
+
+debug = config.getboolean('general', 'debug') #If this is set to true, the program will not actually send messages or start pon. Instead, messages will be displayed in terminal.
+
+alert_after_failures = 3 #A message is only sent once a rule has been checked and failed this many times in succession and then fails again
+minute_interval = int(config.get('monitor', 'minute_interval')) #How many minutes to wait between sending a warning message for the same rule.
 #For example, after sending a message about the power, if the minute interval is set to 2, it will wait 2 minutes before sending another one
 #This will not effect messages of different types. For example, if a message is sent about power, and then the internet goes out, it will not wait to send a message about the internet.
+max_minute_interval = int(config.get('monitor', 'max_minute_interval')) #Longest wait in minutes between messages about a rule that keeps failing without getting worse. The wait starts at minute_interval and doubles after every message
 
-up_env_interval = int(config.get('monitor', 'up_env_interval')) #Intervals in seconds to be used when updating the different parameters. up_env_interval is for updating the temperature and humidity
+up_env_interval = int(config.get('monitor', 'up_env_interval')) #Intervals in seconds to be used when updating the different parameters. up_env_interval is for updating the temperature and humidity. This is the fastest the DHT sampler will read, and never below dht_min_period
 up_conn_interval = int(config.get('monitor', 'up_conn_interval')) #Interval in seconds for testing the internet connection
 up_power_interval = int(config.get('monitor', 'up_power_interval')) #Interval in seconds for testing external power connection
-up_screen_interval = int(config.get('monitor', 'up_screen_interval')) #Interval in seconds for updating LCD screen
 monitor_interval = int(config.get('monitor', 'monitor_interval')) #Interval in seconds for checking the monitored values.
+realert_count = -60 / monitor_interval * minute_interval + alert_after_failures + 1 #Failure counter value after an alert. Monitor goes off every monitor_interval seconds, so this changes the minute interval into checks to wait before the counter can reach alert_after_failures again
+
+up_env_max_interval = int(config.get('monitor', 'up_env_max_interval')) #Longest interval in seconds between temperature and humidity readings while they are stable
+dht_median_samples = int(config.get('monitor', 'dht_median_samples')) #How many readings the median filter uses to reject outliers from the DHT
+dht_retries = int(config.get('monitor', 'dht_retries')) #How many times to retry a failed DHT read before waiting for the next cycle
+
+ups_history = int(config.get('monitor', 'ups_history')) #How many parsed UPS frames to keep besides the latest one
+
+history_file = config.get('monitor', 'history_file') #File the value history is kept in. It stays a fixed size no matter how long the monitor runs
+history_interval = int(config.get('monitor', 'history_interval')) #Interval in seconds between raw history samples
+history_raw_slots = int(config.get('monitor', 'history_raw_slots')) #How many raw samples, 1 minute rollups and 1 hour rollups to keep
+history_minute_slots = int(config.get('monitor', 'history_minute_slots'))
+history_hour_slots = int(config.get('monitor', 'history_hour_slots'))
+history_flush_interval = int(config.get('monitor', 'history_flush_interval')) #Interval in seconds between writing the history to the SD card. The history is kept in memory and only the slots that changed are written, so fewer, larger writes wear the card less
+
+dht_min_period = 2.0 #The DHT22 can't deliver more than one reading every 2 seconds
+env_stable_delta = 0.2 #Temperature change in degrees F below which a reading counts as stable, letting the sampler slow down
+env_bound_margin = 0.1 #Fraction of the temperature range near either bound where the sampler always runs at its fastest interval
 
 #Normal functions to be used
 
-def get_temp(): #Gets input from DHT sensor. Outputs temperature in degrees fahrenheit
-    try:
-        cel = dht_device.temperature #DHT outputs in celsius
-        fah = 1.8 * cel + 32 #Converts to fahrenheit
-        return fah 
-    except (RuntimeError, TypeError) as e: #Filters out random errors thrown by dumb wire stuff. If a value is not returned by this function, the last temperature received is kept.
-        if 'Checksum did not validate' or 'A full buffer was not returned' or "unsupported operand type(s) for *: 'float' and 'NoneType'" in e.args[0]:
-            pass
+class DHTSampler: #Reads temperature and humidity together in one DHT transaction, so each cycle only touches the sensor once
+    def __init__(self, device, min_interval, max_interval, samples, retries):
+        self.device = device
+        self.min_interval = max(min_interval, dht_min_period) #Fastest sampling interval. Never faster than the sensor can deliver readings
+        self.max_interval = max(max_interval, self.min_interval) #Slowest sampling interval, used while readings are stable
+        self.interval = self.min_interval #Current sampling interval, adjusted after every reading by adapt()
+        self.retries = retries
+        self.temp_samples = deque(maxlen=samples) #Last good readings, used for the median filter
+        self.humid_samples = deque(maxlen=samples)
+        self.reads = 0 #Number of physical reads attempted
+        self.failures = 0 #Number of physical reads that failed
+        self.last_latency = 0.0 #Seconds the last physical read took
+        self.total_latency = 0.0 #Seconds spent in all physical reads, used for the average latency
+
+    def read_device(self): #Blocking physical read, run in the executor. Returns (temperature in F, humidity in rH) or None if the read failed
+        start_time = perf_counter()
+        try:
+            cel = self.device.temperature #DHT outputs in celsius. Reading temperature runs the transaction and humidity comes from the same one
+            humidity = self.device.humidity
+        except RuntimeError: #Filters out random errors thrown by dumb wire stuff, like 'Checksum did not validate' and 'A full buffer was not returned'
+            cel = None
+            humidity = None
+        self.last_latency = perf_counter() - start_time
+        self.total_latency += self.last_latency
+        self.reads += 1
+        if cel == None or humidity == None: #The driver sometimes returns None instead of raising
+            self.failures += 1
+            return None
+        return (1.8 * cel + 32, humidity) #Converts to fahrenheit
+
+    async def sample(self): #Returns the median filtered (temperature, humidity) pair, or None if there has never been a good reading
+        delay = dht_min_period
+        for attempt in range(self.retries + 1):
+            reading = await run_blocking(self.read_device) #The DHT is bit-banged and can take a while, so it is read in the executor
+            if reading != None:
+                self.temp_samples.append(reading[0])
+                self.humid_samples.append(reading[1])
+                break
+            if attempt < self.retries: #Backs off before retrying. Reading again right away is what causes most checksum failures
+                await asyncio.sleep(delay)
+                delay *= 2
+        return self.filtered()
+
+    def filtered(self): #Median of the last readings. A single bad reading can't move the median, so spikes are rejected
+        if len(self.temp_samples) == 0:
+            return None
+        return (median(self.temp_samples), median(self.humid_samples))
+
+    def adapt(self, previous_temp, temp, low, high): #Adjusts the sampling interval. Slows down while the temperature is stable and speeds up when it nears or trends toward a bound
+        margin = (high - low) * env_bound_margin
+        change = temp - previous_temp
+        if temp < low + margin or temp > high - margin: #Close to a bound, reads as fast as possible
+            self.interval = self.min_interval
+        elif abs(change) < env_stable_delta: #Stable, doubles the interval up to the maximum
+            self.interval = min(self.interval * 2, self.max_interval)
+        elif (change > 0) == (high - temp < temp - low): #Moving toward the nearest bound, halves the interval
+            self.interval = max(self.interval / 2, self.min_interval)
+
+    def success_rate(self): #Percent of physical reads that returned a value
+        if self.reads == 0:
+            return 100.0
+        return 100.0 * (self.reads - self.failures) / self.reads
+
+    def average_latency(self): #Average seconds per physical read
+        if self.reads == 0:
+            return 0.0
+        return self.total_latency / self.reads
+
+class UPSParser: #Incremental parser for the UPS serial stream. Frames look like "$ SmartUPS V3.2P,Vin GOOD,BATCAP 100,Vout 5250 $" and end with a newline
+    max_frame = 256 #Longest a frame can be. Anything longer without a newline is line noise and is thrown away
+
+    def __init__(self, history):
+        self.buffer = bytearray() #Bytes received that don't make up a complete frame yet. Reused for the whole run
+        self.latest = None #Fields from the newest good frame, or None if there hasn't been one
+        self.latest_time = None #Time the newest good frame was parsed
+        self.history = deque(maxlen=history) #Older good frames, oldest first
+        self.frames = 0 #Number of good frames parsed
+        self.frame_errors = 0 #Number of malformed frames thrown away
+        self.bytes_read = 0 #Number of bytes fed to the parser
+
+    def feed(self, data): #Adds bytes from the serial port and parses every complete frame in them
+        self.bytes_read += len(data)
+        self.buffer += data
+        start = 0
+        end = self.buffer.find(b'\n')
+        while end != -1:
+            self.parse_frame(bytes(self.buffer[start:end]))
+            start = end + 1
+            end = self.buffer.find(b'\n', start)
+        del self.buffer[:start] #Keeps only the incomplete frame at the end
+        if len(self.buffer) > self.max_frame:
+            self.frame_errors += 1
+            self.buffer.clear()
+
+    def parse_frame(self, line): #Parses one frame into a dict of typed fields. Malformed frames are counted and thrown away
+        line = line.strip()
+        if len(line) == 0: #Blank lines between frames
+            return
+        try:
+            if not (line.startswith(b'$') and line.endswith(b'$')):
+                raise ValueError('Missing frame markers')
+            fields = line[1:-1].decode('ascii').strip().split(',')
+            record = {'version' : fields[0]} #First field is the UPS model and firmware version
+            for field in fields[1:]: #Every other field is a name and a value, like "BATCAP 100"
+                name, value = field.strip().split(' ', 1)
+                if value.isdigit():
+                    record[name] = int(value)
+                else:
+                    record[name] = value
+            if not isinstance(record['BATCAP'], int) or 'Vin' not in record:
+                raise ValueError('Bad field value')
+        except (ValueError, KeyError, UnicodeDecodeError): #Frame was cut off or garbled on the wire
+            self.frame_errors += 1
+            return
+        if self.latest != None:
+            self.history.append(self.latest)
+        self.latest = record
+        self.latest_time = now()
+        self.frames += 1
+
+ups_parser = UPSParser(ups_history)
+
+class LCDRenderer: #Keeps a copy of what is on the LCD and only writes the characters that changed, since every write is slow I2C traffic
+    def __init__(self, lcd):
+        self.lcd = lcd
+        self.frame = [' ' * lcd_width for address in lcd_line_addresses] #What is currently on each line of the panel
+        self.bytes_written = 0 #Number of bytes sent to the LCD, counting cursor moves
+        self.lcd.clear() #Starts from a blank panel so the frame matches it
+
+    def render(self, lines): #Updates the panel to show lines. Only the spans that differ from the frame are written, each after one cursor move
+        for row, address in enumerate(lcd_line_addresses):
+            line = lines[row][:lcd_width].ljust(lcd_width)
+            old_line = self.frame[row]
+            column = 0
+            while column < lcd_width:
+                if line[column] == old_line[column]:
+                    column += 1
+                    continue
+                start = column
+                while column < lcd_width and line[column] != old_line[column]: #Finds the end of the changed span
+                    column += 1
+                self.lcd.write(address + start, 0) #Moves the cursor to the start of the span
+                for character in line[start:column]:
+                    self.lcd.write(ord(character), 1)
+                self.bytes_written += 1 + column - start
+            self.frame[row] = line
+
+render_event = None #Set when the lines on the screen need to change. Created by setup(), on the loop that waits on it
+shown_lines = None #Lines output_values last drew, or None before the first draw
+
+def request_render(): #Called after the state changes. Wakes output_values only if the lines it would draw are different, so unchanged readings cost no redraw
+    if screen_lines() != shown_lines:
+        render_event.set()
+
+history_metrics = ['temp', 'humid', 'bat_cap', 'conn', 'pwr_status'] #State values kept in the history
+
+class HistoryTier: #One ring buffer in the history file. Each slot is a timestamp plus one value per metric for raw samples, or min/mean/max per metric for rollups
+    def __init__(self, buffer, offset, slots, columns, period, header, header_index):
+        self.slots = slots
+        self.columns = columns
+        self.period = period #Seconds between entries, so slots * period is how far back the tier goes
+        self.width = columns * len(history_metrics) #Values per slot
+        self.times_offset = offset #Where the tier's timestamps and values start in the file
+        self.times = buffer[offset:offset + slots * 8].cast('d')
+        offset += slots * 8
+        self.values_offset = offset
+        self.values = buffer[offset:offset + slots * self.width * 4].cast('f')
+        self.changed = set() #Slots written since the last changes() call
+        self.header = header
+        self.header_index = header_index #header[header_index] is the next slot to write and header[header_index + 1] is how many slots are filled
+        self.dropped = 0 #Entries thrown away for being older than the newest one
+        self.resets = 0 #Times the tier was emptied because the clock went back further than it reaches
+
+    @staticmethod
+    def size(slots, columns): #Bytes a tier takes up in the file
+        return slots * (8 + columns * len(history_metrics) * 4)
+
+    def append(self, timestamp, row): #Writes one slot, overwriting the oldest once the ring is full. Keeps the timestamps in order when the clock has gone backwards
+        count = self.header[self.header_index + 1]
+        if count > 0 and timestamp < self.time_at(count - 1): #The clock went back, like after a restart on the time fake-hwclock saved
+            if self.time_at(count - 1) - timestamp <= self.slots * self.period: #Drops entries until the clock catches up with the history
+                self.dropped += 1
+                return
+            self.header[self.header_index] = 0 #Too far back to wait out, so the history is started over
+            self.header[self.header_index + 1] = 0
+            self.resets += 1
+        head = self.header[self.header_index]
+        self.times[head] = timestamp
+        self.values[head * self.width:(head + 1) * self.width] = array('f', row)
+        self.header[self.header_index] = (head + 1) % self.slots
+        self.header[self.header_index + 1] = min(self.header[self.header_index + 1] + 1, self.slots)
+        self.changed.add(head)
+
+    def changes(self): #Copies of the slots written since the last call, as (file offset, bytes). Runs of neighbouring slots are copied together, so each becomes one write
+        slots = sorted(self.changed)
+        self.changed.clear()
+        changes = []
+        start = 0
+        while start < len(slots):
+            end = start + 1
+            while end < len(slots) and slots[end] == slots[end - 1] + 1:
+                end += 1
+            first = slots[start]
+            last = slots[end - 1] + 1
+            changes.append((self.times_offset + first * 8, bytes(self.times[first:last])))
+            changes.append((self.values_offset + first * self.width * 4, bytes(self.values[first * self.width:last * self.width])))
+            start = end
+        return changes
+
+    def slot(self, position): #Slot holding the position-th oldest entry
+        return (self.header[self.header_index] - self.header[self.header_index + 1] + position) % self.slots
+
+    def time_at(self, position): #Timestamp of the position-th oldest entry. append() keeps timestamps in order, so entries can be binary searched
+        return self.times[self.slot(position)]
+
+    def search(self, timestamp, after): #Position of the first entry at or after timestamp, or after it when after is True. Written out since bisect only takes a key from Python 3.10
+        low = 0
+        high = self.header[self.header_index + 1]
+        while low < high:
+            middle = (low + high) // 2
+            middle_time = self.time_at(middle)
+            if middle_time < timestamp or (after and middle_time == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, metric, start_time, end_time): #Returns (timestamp, values...) for one metric between start_time and end_time, oldest first
+        first = self.search(start_time, False)
+        last = self.search(end_time, True)
+        column = history_metrics.index(metric) * self.columns
+        rows = []
+        for position in range(first, last):
+            slot = self.slot(position)
+            base = slot * self.width + column
+            rows.append((self.times[slot],) + tuple(self.values[base:base + self.columns]))
+        return rows
+
+class HistoryStore: #Fixed-size history of the monitored values in a file. Keeps raw samples plus 1 minute and 1 hour min/mean/max rollups
+    #The whole file is read into memory when it is opened. Appends only change the copy in memory, and flush() writes the slots that changed
+    magic = 0x53564d48 #Marks the file as a history file
+    version = 1
+
+    def __init__(self, path, raw_slots, minute_slots, hour_slots):
+        header_size = 8 * 8
+        size = header_size + HistoryTier.size(raw_slots, 1) + HistoryTier.size(minute_slots, 3) + HistoryTier.size(hour_slots, 3)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size != size: #New file, or the slot counts in the config changed. The old history can't be read, so it is started over
+            os.ftruncate(self.fd, 0)
+            os.ftruncate(self.fd, size)
+        self.data = bytearray(os.pread(self.fd, size, 0)) #Not a shared map of the file, since the kernel would write its dirty pages back every 30 s or so instead of on the flush interval
+        buffer = memoryview(self.data)
+        self.header = buffer[:header_size].cast('q') #magic, version, then the head and count of each tier
+        if self.header[0] != self.magic or self.header[1] != self.version:
+            self.header[:] = array('q', [self.magic, self.version, 0, 0, 0, 0, 0, 0])
+        offset = header_size
+        self.raw = HistoryTier(buffer, offset, raw_slots, 1, history_interval, self.header, 2)
+        offset += HistoryTier.size(raw_slots, 1)
+        self.minute = HistoryTier(buffer, offset, minute_slots, 3, 60, self.header, 4)
+        offset += HistoryTier.size(minute_slots, 3)
+        self.hour = HistoryTier(buffer, offset, hour_slots, 3, 3600, self.header, 6)
+        self.minute_bucket = None #Rollups being built for the current minute and hour. Each is [start time, sample count, mins, sums, maxes]
+        self.hour_bucket = None
+        self.appends = 0 #Number of samples appended
+        self.total_append_time = 0.0 #Seconds spent appending, used for the average
+
+    def append(self, timestamp, values): #Adds one sample with a value per metric, in history_metrics order
+        start_time = perf_counter()
+        self.raw.append(timestamp, values)
+        self.minute_bucket = self.accumulate(self.minute, 60, self.minute_bucket, timestamp, values)
+        self.hour_bucket = self.accumulate(self.hour, 3600, self.hour_bucket, timestamp, values)
+        self.appends += 1
+        self.total_append_time += perf_counter() - start_time
+
+    def accumulate(self, tier, period, bucket, timestamp, values): #Adds a sample to a rollup. Once a new period starts, the finished rollup is written to its tier
+        start = timestamp - timestamp % period
+        if bucket != None and bucket[0] != start:
+            row = []
+            for index in range(len(history_metrics)):
+                row.extend((bucket[2][index], bucket[3][index] / bucket[1], bucket[4][index]))
+            tier.append(bucket[0], row)
+            bucket = None
+        if bucket == None:
+            return [start, 1, list(values), list(values), list(values)]
+        bucket[1] += 1
+        for index, value in enumerate(values):
+            bucket[2][index] = min(bucket[2][index], value)
+            bucket[3][index] += value
+            bucket[4][index] = max(bucket[4][index], value)
+        return bucket
+
+    def window(self, metric, seconds): #Returns the entries for the last seconds of one metric, from the finest tier that covers the whole window
+        end_time = now()
+        if seconds <= self.raw.slots * history_interval:
+            tier = self.raw
+        elif seconds <= self.minute.slots * 60:
+            tier = self.minute
         else:
-            raise
+            tier = self.hour
+        return tier.query(metric, end_time - seconds, end_time)
 
-def get_humid(): #Gets input from DHT sensor. Outputs value in relative humidity
-    try:
-        humidity = dht_device.humidity
-        return humidity
-    except RuntimeError as e: #Filters out random errors thrown. If a value is not returned by the function, the last rH value received is kept
-        if 'Checksum did not validate' or 'A full buffer was not returned' in e.args[0]:
+    def change(self, metric, seconds): #How much a metric changed over the last seconds, or None if there isn't enough history. Uses the mean for rollups
+        rows = self.window(metric, seconds)
+        if len(rows) < 2:
+            return None
+        column = 1 if len(rows[0]) == 2 else 2 #Raw entries are (time, value), rollups are (time, min, mean, max)
+        return rows[-1][column] - rows[0][column]
+
+    def changes(self): #Copies of the parts of the file changed since the last call, as (file offset, bytes). Made on the loop, so write() can run in the executor while appends go on
+        changes = [(0, bytes(self.header))]
+        for tier in (self.raw, self.minute, self.hour):
+            changes.extend(tier.changes())
+        return changes
+
+    def write(self, changes): #Writes the changes to the SD card and waits for them to get there
+        for offset, data in changes:
+            os.pwrite(self.fd, data, offset)
+        os.fsync(self.fd)
+
+    def flush(self): #Writes everything changed since the last flush
+        self.write(self.changes())
+
+    def dropped(self): #Samples and rollups thrown away because the clock went backwards
+        return self.raw.dropped + self.minute.dropped + self.hour.dropped
+
+    def average_append(self): #Average seconds per append
+        if self.appends == 0:
+            return 0.0
+        return self.total_append_time / self.appends
+
+wall_clock_offset = 0.0 #Difference between the wall clock and the event loop clock, set when the monitor starts
+
+def now(): #Wall clock time, following the event loop clock. The replay harness speeds up the loop clock, and every timestamp the monitor keeps speeds up with it
+    return wall_clock_offset + asyncio.get_running_loop().time()
+
+def run_blocking(func, *args): #Runs a blocking driver call in the executor. Awaiting the result lets the other tasks keep running while the driver waits on hardware or the network
+    return asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+class Rule: #One alert condition, read from a [rule name] section of setup.conf
+    conditions = ('range', 'bool', 'rate') #range: value has to stay between low and high. bool: value has to be 1. rate: value can't change more than max_change over window seconds
+
+    def __init__(self, name, section):
+        self.name = name
+        self.metric = section.get('metric') #Name of the state value the rule checks
+        self.condition = section.get('condition')
+        if self.condition not in self.conditions:
+            raise ValueError('Rule ' + name + ' has unknown condition ' + str(self.condition) + '. Use one of ' + ', '.join(self.conditions))
+        if self.metric not in history_metrics: #Only the numeric values kept in the history can be checked. Anything else would fail every check, so it is caught when the config is read
+            raise ValueError('Rule ' + name + ' has unknown metric ' + str(self.metric) + '. Use one of ' + ', '.join(history_metrics))
+        self.low = section.getfloat('low', float('-inf'))
+        self.high = section.getfloat('high', float('inf'))
+        self.hysteresis = section.getfloat('hysteresis', 0.0) #Once a range rule fails, the value has to be this far inside the range to pass again, so it doesn't flap at the edge
+        self.max_change = section.getfloat('max_change', 0.0)
+        self.window = section.getint('window', 600)
+        self.sustain = section.getint('sustain', 0) #Seconds the condition has to keep failing before the check counts as failed
+        self.placeholder = section.get('placeholder', self.metric) #State value the _PLACEHOLDER_ in the messages is filled in with
+        if self.placeholder not in history_metrics:
+            raise ValueError('Rule ' + name + ' has unknown placeholder ' + self.placeholder + '. Use one of ' + ', '.join(history_metrics))
+        self.message = self.read_message(section, 'message')
+        self.message_low = self.read_message(section, 'message_low', self.message) #Range rules can have different messages for too low and too high
+        self.message_high = self.read_message(section, 'message_high', self.message)
+        self.recovered = self.read_message(section, 'recovered', name + ' is back to normal') #Used in the recovered summary
+        self.escalate = section.getfloat('escalate', 0.0) #How much worse the failure has to get to send another message before the back-off is over. 0 only repeats on the back-off
+
+    def read_message(self, section, key, fallback=''): #Messages are written on one line in the config, with \n for line breaks
+        return section.get(key, fallback).replace('\\n', '\n')
+
+    def build_message(self, snapshot): #Used to build the warning message without the header, filling in the _PLACEHOLDER_ with the current value
+        if self.condition == 'rate':
+            value = history.change(self.metric, self.window)
+        else:
+            value = snapshot[self.placeholder]
+        if isinstance(value, float):
+            value = round(value, 1)
+        message = self.message
+        if self.condition == 'range': #Uses the bounds narrowed by the hysteresis, since a failing value stays failing until it is that far back inside the range
+            if snapshot[self.metric] < self.low + self.hysteresis: #If the value is too low, send a low warning
+                message = self.message_low
+            elif snapshot[self.metric] > self.high - self.hysteresis: #If the value is too high, send a high warning
+                message = self.message_high
+        return message.replace('_PLACEHOLDER_', str(value))
+
+    def severity(self, snapshot): #How bad the failure is, used to tell whether it got worse since the last message
+        if self.condition == 'range': #How far the value is outside the range
+            return max(self.low - snapshot[self.metric], snapshot[self.metric] - self.high)
+        if self.condition == 'rate': #How big the change is
+            change = history.change(self.metric, self.window)
+            return 0.0 if change == None else abs(change)
+        if self.placeholder != self.metric: #Bool rules get worse as their placeholder value drops, like the battery while the power is out
+            return -snapshot[self.placeholder]
+        return 0.0
+
+class RuleEngine: #Checks every rule against a snapshot of the state. Rules are grouped by condition at startup, so each check is one pass per condition over flat lists
+    def __init__(self, rules):
+        self.rules = rules
+        self.by_name = {rule.name : rule for rule in rules}
+        self.counts = [0] * len(rules) #How many times each rule has been checked and failed in succession. Goes negative after an alert, see realert_count
+        self.failing = [False] * len(rules) #Whether each condition failed on the last check, before sustain is applied. Used for hysteresis
+        self.fail_start = [None] * len(rules) #Time each condition started failing, used for sustain
+        self.range_rules = [index for index, rule in enumerate(rules) if rule.condition == 'range']
+        self.range_metrics = [rules[index].metric for index in self.range_rules]
+        self.range_low = [rules[index].low for index in self.range_rules]
+        self.range_high = [rules[index].high for index in self.range_rules]
+        self.range_hysteresis = [rules[index].hysteresis for index in self.range_rules]
+        self.bool_rules = [index for index, rule in enumerate(rules) if rule.condition == 'bool']
+        self.bool_metrics = [rules[index].metric for index in self.bool_rules]
+        self.rate_rules = [index for index, rule in enumerate(rules) if rule.condition == 'rate']
+        self.sustain = [rule.sustain for rule in rules]
+
+    def evaluate(self, snapshot, now): #Returns whether each rule failed this check, in the same order as self.rules
+        failing = [False] * len(self.rules)
+        for index, metric, low, high, hysteresis in zip(self.range_rules, self.range_metrics, self.range_low, self.range_high, self.range_hysteresis):
+            if self.failing[index]: #Already failing, so the range is narrowed by the hysteresis
+                low += hysteresis
+                high -= hysteresis
+            failing[index] = not (low <= snapshot[metric] <= high)
+        for index, metric in zip(self.bool_rules, self.bool_metrics):
+            failing[index] = snapshot[metric] != 1
+        for index in self.rate_rules: #Rate rules read their change from the history instead of the snapshot
+            rule = self.rules[index]
+            change = history.change(rule.metric, rule.window)
+            failing[index] = change != None and abs(change) > rule.max_change
+        self.failing = failing
+        results = []
+        for index, failed in enumerate(failing): #Applies sustain. A condition only counts as failed once it has been failing for sustain seconds
+            if not failed:
+                self.fail_start[index] = None
+                results.append(False)
+                continue
+            if self.fail_start[index] == None:
+                self.fail_start[index] = now
+            results.append(now - self.fail_start[index] >= self.sustain[index])
+        return results
+
+    def bounds(self, metric): #Returns (low, high) of the first range rule on a metric, or None if there isn't one
+        for index in self.range_rules:
+            if self.rules[index].metric == metric:
+                return (self.rules[index].low, self.rules[index].high)
+        return None
+
+def load_rules(config): #Reads every [rule name] section of the config into a RuleEngine
+    rules = []
+    for section in config.sections():
+        if section.startswith('rule '):
+            rules.append(Rule(section[len('rule '):], config[section]))
+    return RuleEngine(rules)
+
+rule_engine = load_rules(config)
+
+def snapshot(): #Current state values the rules are checked against
+    return vars(state)
+
+def format_duration(seconds): #Formats how long a condition has lasted for messages, like "1 h 5 min"
+    minutes = int(seconds // 60)
+    if minutes < 1:
+        return 'under 1 min'
+    if minutes < 60:
+        return str(minutes) + ' min'
+    return str(minutes // 60) + ' h ' + str(minutes % 60) + ' min'
+
+class AlertDigest: #Collects the alerts raised within alert_digest_window seconds and queues them as one message, so an outage that trips several values sends one text per phone number
+    def __init__(self, window):
+        self.window = window
+        self.alerts = [] #Values alerted on since the last digest, in the order they were raised. Each value is only listed once
+        self.alerted = set() #Values that have been alerted on and are still failing
+        self.recovered = {} #Values that were alerted on and have passed since, with how long they were failing
+        self.since = {} #Time each currently failing value started failing
+        self.flush_handle = None #Timer that sends the digest once the window is over. None when no digest is waiting
+        self.repeats = {} #For each value alerted on and still failing: [messages sent about it after the first, re-alerts held back since the last one, severity at the last one]
+        self.suppressed = 0 #Number of re-alerts held back because the value hadn't got worse
+
+    def failing(self, value_name): #Called every time a value fails its check. Records when the condition started
+        if value_name not in self.since:
+            self.since[value_name] = now()
+
+    def passing(self, value_name): #Called every time a value passes its check
+        start_time = self.since.pop(value_name, None)
+        if value_name in self.alerted: #A value that was alerted on has recovered
+            self.alerted.remove(value_name)
+            self.repeats.pop(value_name, None) #The next failure starts a new back-off
+            self.recovered[value_name] = now() - start_time
+            if len(self.alerted) == 0: #Only sends the recovered summary once every alerted value is passing
+                self.schedule()
+
+    def add(self, value_name): #Adds an alert to the next digest. While a value keeps failing, it is only alerted on again once it got worse or the back-off ran out
+        rule = rule_engine.by_name[value_name]
+        severity = rule.severity(snapshot())
+        repeat = self.repeats.get(value_name)
+        if repeat == None: #First alert since the value started failing
+            self.repeats[value_name] = [0, 0, severity]
+        else: #monitor_values re-alerts every minute_interval. The back-off lets 1, then 2, then 4 of those go by and so on, up to max_minute_interval
+            wait = min(2 ** repeat[0], max(max_minute_interval // minute_interval, 1))
+            worse = rule.escalate > 0 and severity - repeat[2] >= rule.escalate
+            if not worse and repeat[1] + 1 < wait:
+                repeat[1] += 1
+                self.suppressed += 1
+                return
+            self.repeats[value_name] = [repeat[0] + 1, 0, severity]
+        if value_name not in self.alerts:
+            self.alerts.append(value_name)
+        self.alerted.add(value_name)
+        self.schedule()
+
+    def schedule(self): #Starts the window timer if it isn't already running
+        if self.flush_handle == None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self): #Builds the digest from everything collected in the window and queues it
+        self.flush_handle = None
+        current_time = now()
+        lines = []
+        for value_name in self.alerts:
+            if value_name in self.since: #Values that recovered within the window are left out, they are covered by the recovered summary
+                rule = rule_engine.by_name[value_name]
+                message = rule.build_message(snapshot()) + '\nFailing for ' + format_duration(current_time - self.since[value_name])
+                if rule.condition == 'range' and rule.metric in history_metrics: #Adds how fast the value is moving, from the history
+                    change = history.change(rule.metric, 600)
+                    if change != None:
+                        message += '\nChange in last 10 min: ' + format(change, '+.1f')
+                lines.append(message)
+        self.alerts = []
+        if len(self.alerted) == 0 and len(self.recovered) > 0: #Every alerted value is passing again
+            recovered_lines = []
+            for value_name, duration in self.recovered.items():
+                recovered_lines.append(rule_engine.by_name[value_name].recovered + ' after ' + format_duration(duration))
+            lines.append('RECOVERED\n' + '\n'.join(recovered_lines))
+            self.recovered = {}
+        if len(lines) > 0:
+            alert_queue.put(location + ' SERVER ALERT\n' + '\n\n'.join(lines))
+
+class AlertQueue: #Bounded queue of alerts waiting to be sent. Every change is written to the journal file, so alerts raised during an outage are still sent after a restart
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.pending = deque() #Alerts waiting to be sent, oldest first. Each alert is a dict with the message, the phone numbers still to send to and the time it was queued
+        self.ready = asyncio.Event() #Set while there are alerts waiting, so the dispatcher can sleep until one is queued
+        self.sending = None #Alert the dispatcher is sending. It is always pending[0] and is never dropped, since done() still has to remove it
+        self.delivered = 0 #Number of alerts sent to every phone number
+        self.total_latency = 0.0 #Seconds from queueing to delivery for all delivered alerts, used for the average latency
+        self.last_latency = 0.0 #Seconds from queueing to delivery for the last delivered alert
+        self.dropped = 0 #Number of alerts dropped because the queue was full
+        self.given_up = 0 #Number of alerts that still failed after every retry
+        self.journal = None #Newest contents for the journal that haven't been written yet
+        self.writer = None #Task writing the journal in the executor. None until the first save()
+        self.load()
+
+    def load(self): #Reads alerts left in the journal by the last run
+        try:
+            with open(self.path) as journal:
+                self.pending.extend(json.load(journal))
+        except FileNotFoundError: #No journal means nothing was left to send
             pass
+        except ValueError: #A journal cut off by a power loss can't be read, so it is started over
+            print('Alert journal ' + self.path + ' is unreadable, starting a new one')
+        if len(self.pending) > 0:
+            print('Loaded ' + str(len(self.pending)) + ' unsent alerts from ' + self.path)
+            self.ready.set()
+
+    def save(self): #Queues the pending alerts to be written to the journal. The fsync can take hundreds of ms on an SD card, so the write runs in the executor
+        self.journal = json.dumps(list(self.pending)) #Made on the loop, since the dispatcher changes the alerts while they are sent
+        if self.writer == None or self.writer.done():
+            self.writer = asyncio.ensure_future(self.write_journal())
+
+    async def write_journal(self): #Writes the journal until it has the newest contents. Only one write runs at a time, so an older one can never land last
+        while self.journal != None:
+            journal = self.journal
+            self.journal = None
+            try:
+                await run_blocking(self.write, journal)
+            except OSError as e: #Card full or read-only. The alerts are still in memory, so they are sent anyway
+                print('Could not write alert journal ' + self.path + ': ' + str(e))
+
+    def write(self, journal): #Writes a temporary file and renames it, so a power loss never leaves half a journal
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as journal_file:
+            journal_file.write(journal)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temp_path, self.path)
+
+    async def saved(self): #Waits until the journal has been written
+        if self.writer != None:
+            await self.writer
+
+    def put(self, message): #Queues an alert for every phone number in the alert_list. Returns right away, the dispatcher does the sending
+        sending = 1 if self.sending != None else 0
+        if len(self.pending) - sending >= self.maxsize: #If the queue is full, drops the oldest alert that isn't being sent to make room
+            dropped = self.pending[sending]
+            del self.pending[sending]
+            self.dropped += 1
+            print('Alert queue full, dropped alert: ' + dropped['message'])
+        self.pending.append({'message' : message, 'recipients' : list(alert_list), 'queued' : now()})
+        self.save()
+        self.ready.set()
+
+    async def get(self): #Waits until there is an alert to send and returns the oldest one. It stays in the queue until done() is called
+        while len(self.pending) == 0:
+            self.ready.clear()
+            await self.ready.wait()
+        self.sending = self.pending[0]
+        return self.sending
+
+    def done(self, alert): #Removes an alert from the queue once it has been sent or given up on
+        self.sending = None
+        for index, pending in enumerate(self.pending): #Compared by identity, since two alerts can have the same contents
+            if pending is alert:
+                del self.pending[index]
+                break
+        self.save()
+
+    def average_latency(self): #Average seconds from queueing an alert to sending it
+        if self.delivered == 0:
+            return 0.0
+        return self.total_latency / self.delivered
+
+alert_digest = AlertDigest(alert_digest_window)
+
+async def send_sms(message, phone_number): #Sends one message to one phone number
+    if debug == True: #Simply prints out the message instead of actually sending it, so you don't accidentally spend money
+        print('Message sent to "' + phone_number + '":')
+        print(message)
+    else:
+        await run_blocking(lambda: hw.sms.messages.create(
+            body=message,
+            from_=messenger_number,
+            to=phone_number
+            )) #Twilio's client blocks on HTTP, so it runs in the executor. Every send shares the client's pooled HTTP session
+
+async def send_alert(alert): #Sends an alert to all of its phone numbers at once, retrying the ones that failed with backoff. Returns True if every number was sent to
+    delay = alert_retry_delay
+    for attempt in range(alert_retries + 1):
+        results = await asyncio.gather(*[send_sms(alert['message'], phone_number) for phone_number in alert['recipients']], return_exceptions=True)
+        failed = []
+        for phone_number, result in zip(alert['recipients'], results):
+            if isinstance(result, Exception):
+                print('Message to "' + phone_number + '" failed: ' + str(result))
+                failed.append(phone_number)
+        alert['recipients'] = failed #Only the phone numbers that failed are retried
+        alert_queue.save()
+        if len(failed) == 0:
+            return True
+        if attempt < alert_retries:
+            await asyncio.sleep(delay)
+            delay *= 2
+    return False
+
+async def dispatch_alerts(): #Task that sends queued alerts one at a time, so checking values never waits on sending messages
+    has_lease = False #Whether the dispatcher is holding the SIM connection up
+    while True:
+        if has_lease and len(alert_queue.pending) == 0: #Queue is drained, lets the SIM connection go down
+            link_manager.release()
+            has_lease = False
+        alert = await alert_queue.get()
+        if state.conn == 0 and not has_lease: #If internet is not connected (Need to use SIM Module). Holds the SIM connection up until the queue is drained
+            has_lease = True
+            if not await link_manager.acquire():
+                print('SIM connection did not come up, trying to send anyway')
+        if await send_alert(alert):
+            alert_queue.last_latency = now() - alert['queued']
+            alert_queue.total_latency += alert_queue.last_latency
+            alert_queue.delivered += 1
         else:
-            raise
-        
-def send_message(value_name): #Used to send out warning messages. Value Name is the type of warning message sent, which uses the message_dict to build the message
-    if conn.value == 0: #If internet is not connected (Need to use SIM Module)
-        pon_function.value = 1 #Starts pon, which creates an internet connection over SIM. Runs for 60 seconds before terminating
-        sleep(15) #15 seconds after starting pon, the message will be sent
-    if check_value_dict[value_name][1] == 'range': #If value type is range
-        range_low = check_value_dict[value_name][2] #stores the high and low values of the range
-        range_high = check_value_dict[value_name][3]
-        if value_name == 'temp': #If the message to be sent is a temperature warning
-            if temp.value < range_low: #If the value is too low, send a cold warning
-                message_id = 'temp_cold'
-            elif temp.value > range_high: #If the valeu is too high, send a hot warning
-                message_id = 'temp_hot'
-            message = location + ' SERVER ALERT\n' + message_dict[message_id].replace('_PLACEHOLDER_', str(round(temp.value, 1))) #Replaces placeholder in the message with the current temperature.
-        elif value_name == 'humid': #If the message to be sent is a humidity warning
-            if humid.value < range_low: #If the value is too low, send a low warning
-                message_id = 'humid_low'
-            elif humid.value > range_high: #If the value is too high, send a high warning
-                message_id = 'humid_high'
-            message = location + ' SERVER ALERT\n' + message_dict[message_id].replace('_PLACEHOLDER_', str(round(humid.value, 1))) #Replaces placeholder in the message with the current Humidity level.
-    else: #If value type is not range, meaning it is a boolean
-        if value_name == 'power': #If the message to be sent is a power warning
-            message_id = value_name
-            message = location + ' SERVER ALERT\n' + message_dict[message_id].replace('_PLACEHOLDER_', str(bat_cap.value))#Replaces placeholder with current UPS battery percentage
+            print('Giving up on alert: ' + alert['message'])
+            alert_queue.given_up += 1
+        alert_queue.done(alert)
+
+class LinkManager: #Manages the SIM connection. Brings it up with pon while something holds a lease on it and takes it down with poff once the last lease is released
+    def __init__(self, interface_dir, pon_command, poff_command, up_timeout, idle_timeout, simulated):
+        self.state_path = os.path.join(interface_dir, 'ppp0', 'operstate') #ppp0 is the connection type that the sim uses. Its operstate file only exists while it is connected
+        self.pon_command = shlex.split(pon_command)
+        self.poff_command = shlex.split(poff_command)
+        self.up_timeout = up_timeout
+        self.idle_timeout = idle_timeout
+        self.simulated = simulated #If true, pon and poff are not actually run and ppp0 is pretended to come up right away. Used in debug mode and by the replay harness
+        self.leases = 0 #Number of tasks that currently need the connection
+        self.started = False #Whether this manager brought the connection up. A connection brought up by something else is never taken down
+        self.bring_up_task = None #Task running pon and waiting for ppp0, shared by every acquire() made while it runs
+        self.idle_handle = None #Timer that takes the connection down after idle_timeout
+        self.simulated_up = False #Stands in for ppp0 when simulated, since pon is not actually run
+        self.session_start = 0.0 #Loop time pon was run for the current session
+        self.bring_ups = 0 #Number of times the connection was brought up
+        self.last_bring_up = 0.0 #Seconds the last bring up took
+        self.total_bring_up = 0.0 #Seconds spent in all bring ups, used for the average
+        self.sessions = 0 #Number of finished sessions
+        self.total_session = 0.0 #Seconds from pon to poff for all finished sessions, used for the average
+
+    def is_up(self): #Checks whether ppp0 is up by reading sysfs, without starting a shell
+        if self.simulated == True:
+            return self.simulated_up
+        try:
+            with open(self.state_path) as operstate:
+                return operstate.read().strip() != 'down' #ppp interfaces report 'unknown' rather than 'up' when connected
+        except OSError: #No ppp0 interface
+            return False
+
+    async def acquire(self): #Takes a lease on the connection and waits for it to come up. Returns True if it is up
+        self.leases += 1
+        if self.idle_handle != None: #The connection is needed again before the idle timer ran out
+            self.idle_handle.cancel()
+            self.idle_handle = None
+        if self.is_up():
+            return True
+        if self.bring_up_task == None or self.bring_up_task.done():
+            self.bring_up_task = asyncio.create_task(self.bring_up())
+        return await asyncio.shield(self.bring_up_task) #Shielded so one caller being cancelled doesn't stop the bring up for the others
+
+    def release(self): #Releases a lease. The connection goes down idle_timeout seconds after the last lease is released
+        self.leases -= 1
+        if self.leases == 0 and self.started:
+            loop = asyncio.get_running_loop()
+            self.idle_handle = loop.call_later(self.idle_timeout, lambda: loop.create_task(self.take_down()))
+
+    async def bring_up(self): #Runs pon and waits for ppp0 to come up. Returns True if it came up within up_timeout
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        if self.simulated == True: #Starting pon uses a minimal amount of data, so debug just sends a message to terminal
+            print('Starting Pon...')
+            self.simulated_up = True
         else:
-            message_id = value_name
-            message = location + ' SERVER ALERT\n' + message_dict[message_id]
-    if debug == True:
-        for phone_number in alert_list: #Simply prints out the message instead of actually sending it, so you don't accidentally spend money
-            print('Message sent to "' + phone_number + '":')
-            print(message)
-    elif debug == False: #Sends out a message to every phone number in the alert_list
-        for phone_number in alert_list:
-            message = Client.messages.create(
-                body=message,
-                from_=messenger_number,
-                to=phone_number
-                )
-
-def check_value(value_name): #Used to check that a monitored value is where it is supposed to be. Returns True or False. Input is the name of the value to check
-    value_check = True #Initializes the check to True (passing). If the value fails, this bool will be set to false
-    if check_value_dict[value_name][1] == 'range': #According to the value dictionary, if the value type should be between a range
-        range_low = check_value_dict[value_name][2] #Stores the high and low values of the range
-        range_high = check_value_dict[value_name][3]
-        if value_name == 'temp': #If the checked value is temperature
-            if temp.value < range_low or temp.value > range_high: #If multiprocessing temperature value is outside of the range
-                value_check = False
-        if value_name == 'humid': #If the checked value is humidity
-            if humid.value < range_low or humid.value > range_high: #If multiprocessing humidity value is outside of the range
-                value_check = False
-    elif check_value_dict[value_name][1] == 'bool': #If the value type is a boolean. Boolean values pass if they are 1
-        if value_name == 'internet': #If checked value is internet connection
-            if conn.value == 0: #If internet connection is unavailable
-                value_check = False
-        if value_name == 'power': #If checked value is external power
-            if pwr_status.value == 0: #If external power is unavailable
-                value_check = False
-    return value_check #Returns the results of the value check.
-
-def start_pon(): #Function called to start pon. If pon_function.value is set to 1, the multiprocessing caller function will call this function.
-    if debug == True: #Starting pon uses a minimal amount of data, so debug just sends a message to terminal
-        print('Starting Pon...')
-        sleep(60)
-        print('Ending Pon...')
-    elif debug == False:
-        comm = os.popen('ip a|grep ppp0').read() #ppp0 is the connection type that the sim uses. 
-        if comm == '': #If ppp0 is not listed as a connection type (If pon is not already running)
-            pon_proc = subprocess.Popen(['sudo pon'], shell=True) #Runs the pon command
-            sleep(60) #Sleeps for 60 seconds, which is ample time to send a message
-            os.killpg(os.getpgid(pon_proc.pid), signal.SIGTERM) #Kills the pon process
-    pon_function.value = 0 #Sets this value back to 0 after the function is called so it doesn't start an infinite loop.
-
-#Multiprocessing functions. These run for the duration of the program.
-
-def update_values(this_temp, this_humid): #Used to update the temperature and humidity multiprocessing values.
-    while True: #this_temp and this_humid are the last temp/humidity values that were set.
-        new_temp = get_temp()
-        new_humid = get_humid()
-        if new_temp == None:
-            pass #If no value is returned by the temperature function, does not overwrite the last value given
+            try:
+                pon_proc = await asyncio.create_subprocess_exec(*self.pon_command)
+                await pon_proc.wait() #pon returns once pppd has started in the background
+            except OSError as e: #pon is missing or pon_command is wrong. Alerts are still tried over whatever connection there is
+                print('Could not run ' + ' '.join(self.pon_command) + ': ' + str(e))
+                return False
+        self.started = True #Set even if ppp0 never comes up, so poff still stops pppd once the lease is released
+        self.session_start = start_time
+        while not self.is_up(): #Polls the operstate file until ppp0 is up
+            if loop.time() - start_time > self.up_timeout:
+                print('ppp0 did not come up within ' + str(self.up_timeout) + ' seconds')
+                return False
+            await asyncio.sleep(0.5)
+        self.last_bring_up = loop.time() - start_time
+        self.total_bring_up += self.last_bring_up
+        self.bring_ups += 1
+        return True
+
+    async def take_down(self): #Runs poff if the connection is still unused. Also called on shutdown
+        self.idle_handle = None
+        if self.leases > 0 or not self.started:
+            return
+        self.started = False
+        self.total_session += asyncio.get_running_loop().time() - self.session_start
+        self.sessions += 1
+        if self.simulated == True:
+            print('Ending Pon...')
+            self.simulated_up = False
         else:
-            this_temp = new_temp
-        if new_humid == None:
-            pass #If no value is returned by the humdity function, does not overwrite the last value given
+            try:
+                poff_proc = await asyncio.create_subprocess_exec(*self.poff_command)
+                await poff_proc.wait()
+            except OSError as e:
+                print('Could not run ' + ' '.join(self.poff_command) + ': ' + str(e))
+
+    def average_bring_up(self): #Average seconds from running pon to ppp0 being up
+        if self.bring_ups == 0:
+            return 0.0
+        return self.total_bring_up / self.bring_ups
+
+    def average_session(self): #Average seconds from pon to poff
+        if self.sessions == 0:
+            return 0.0
+        return self.total_session / self.sessions
+
+link_manager = LinkManager(link_interface_dir, pon_command, poff_command, link_up_timeout, link_idle_timeout, debug or simulate)
+
+class ConnProber: #Tests the internet connection by connecting to several targets at once. Every socket has its own timeout, so no other socket in the process is affected
+    def __init__(self, targets, quorum, timeout, degraded_rtt, history):
+        self.targets = [(host, int(port)) for host, port in targets]
+        self.quorum = min(quorum, len(self.targets)) #Can't require more targets than there are
+        self.timeout = timeout
+        self.degraded_rtt = degraded_rtt / 1000 #Stored in seconds like the round trip times
+        self.rtts = {target : deque(maxlen=history) for target in self.targets} #Rolling window of round trip times in seconds per target. None marks a failed connection
+        self.probes = 0 #Number of probes run
+        self.last_cost = 0.0 #CPU seconds the last probe took
+        self.total_cost = 0.0 #CPU seconds all probes took, used for the average
+
+    async def probe_target(self, host, port): #Opens a connection to one target. Returns the round trip time in seconds, or None if it failed
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+        except (OSError, asyncio.TimeoutError): #If connection is unsuccessful
+            return None
+        rtt = loop.time() - start_time
+        writer.close() #closes socket
+        return rtt
+
+    async def probe(self): #Probes every target in parallel. Returns 'connected', 'degraded' or 'disconnected'
+        start_cost = process_time()
+        results = await asyncio.gather(*[self.probe_target(host, port) for host, port in self.targets])
+        connected = 0
+        for target, rtt in zip(self.targets, results):
+            self.rtts[target].append(rtt)
+            if rtt != None:
+                connected += 1
+        self.last_cost = process_time() - start_cost
+        self.total_cost += self.last_cost
+        self.probes += 1
+        if connected < self.quorum:
+            return 'disconnected'
+        if connected < len(self.targets) or self.average_rtt() > self.degraded_rtt: #Up, but some targets failed or everything is slow
+            return 'degraded'
+        return 'connected'
+
+    def average_rtt(self, target=None): #Average round trip time in seconds over the rolling window, for one target or all of them
+        if target == None:
+            rtts = [rtt for window in self.rtts.values() for rtt in window if rtt != None]
         else:
-            this_humid = new_humid
-        temp.value = this_temp #Sets the multiprocessing values for temperature and humidity. If they were not changed, keeps the last value given.
-        humid.value = this_humid
-        sleep(up_env_interval)
+            rtts = [rtt for rtt in self.rtts[target] if rtt != None]
+        if len(rtts) == 0:
+            return 0.0
+        return sum(rtts) / len(rtts)
 
-def check_button(): #Multiprocessing function to monitor the button presses
-    while True:
-        start_time = time() #Initializes button press start time 
-        diff = 0 #Initializes difference between the start time and button release time
-        while button.is_active and (diff < hold_time): #When button is pressed and the amount of time it's been held down is less than the amount required to trigger a secondary action
-            now_time = time() #Gets current time
-            diff = now_time - start_time #Sets difference to the current time minus the time at the start of the button press. This measures how long the press was.
-            
-        if diff < hold_time and diff != 0: #If the button was actually pressed and it was held down for less than the required hold time
-            try:
-                screen.value = screen_list[screen.value + 1] #Tries to increase the screen value by 1
-            except IndexError:
-                screen.value = 0 #If screen value is at the highest value already, loops it back to 0
-            print('Pressed, screen = ' + str(screen.value))
-            sleep(.5) #Sleeps for .5 seconds so it doesn't trigger a bunch of times or to fast. Basically button sensitivity
-        elif diff > hold_time: #If held down for long enough to trigger secondary action
-            if display.value == 1: #Toggles the display boolean. This does not disable the backlight, but the actual text.
-                display.value = 0
-            else:
-                display.value = 1
-            sleep(1)
-    
-def check_conn(): #Function used to monitor the internet connection
+    def average_cost(self): #Average CPU seconds per probe
+        if self.probes == 0:
+            return 0.0
+        return self.total_cost / self.probes
+
+conn_prober = ConnProber(check_targets, check_quorum, check_timeout, check_degraded_rtt, check_history)
+
+#Scheduler tasks. Each one is a single tick, and run_every calls it on its configured interval.
+
+tick_stats = metrics.TickStats() #Timings of every periodic task, published by the metrics endpoint
+
+async def run_every(interval, tick): #Calls the tick coroutine every interval seconds for the duration of the program.
+    loop = asyncio.get_running_loop()
+    worker = tick_stats.add(tick.__name__, interval)
+    next_time = loop.time()
     while True:
-        comm = os.popen('ip a|grep ppp0').read() #ppp0 is the connection type that the sim uses. 
-        if comm == '': #If ppp0 is not listed as a connection type (If main internet connection is over wlan)
-            try:
-                socket.setdefaulttimeout(3) #Creates a socket to google over port 43 with a timeout tolerance of 3 seconds
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                server_address = (check_conn_host,check_conn_port)
-                s.connect(server_address)
-            except OSError: #If connection is unsuccessful
-                conn.value = 0 #value of 0 indicates no connection
-            else: #if connection is successful
-                s.close() #closes socket
-                conn.value = 1 #value of 1 indicates successful connection
-        sleep(up_conn_interval)
-        
-def check_power(): #Used to monitor the external power connection
+        tick_start = loop.time()
+        try:
+            await tick()
+        except Exception: #An unexpected error in one tick, like a driver failing in a new way, shouldn't stop the task for the rest of the run
+            print('Error in ' + tick.__name__ + ', trying again next interval:')
+            traceback.print_exc()
+        tick_stats.record(worker, loop.time() - tick_start, tick_start - next_time, interval) #Lag is how late the tick started
+        next_time += interval #Schedules from the last start time rather than the end of the tick, so slow ticks don't drift the interval
+        if next_time < loop.time(): #If the tick overran its interval, starts the next one now instead of trying to catch up
+            next_time = loop.time()
+        await asyncio.sleep(next_time - loop.time())
+
+async def update_values(): #Used to update the temperature and humidity values. Runs on the sampler's adaptive interval rather than a fixed one
+    loop = asyncio.get_running_loop()
+    worker = tick_stats.add('update_values', dht_sampler.interval)
+    next_time = loop.time()
     while True:
+        tick_start = loop.time()
+        previous_temp = state.temp
         try:
-            serial_data = str(ups.readline()).split(',') #UPS is set up as a serial device. Stores information sent
-            ext_status = serial_data[1].replace('Vin ', '') #Data sent that confirms whether exernal power is connected
-            batcap = serial_data[2].replace('BATCAP ', '') #Battery capacity percentage
-            if 'GOOD' in ext_status: #If external power message contains "GOOD"
-                pwr_status.value = 1 #pwr_status set to 1 indicates external power connection
-            else:
-                pwr_status.value = 0
-            bat_cap.value = int(batcap) #Converts string sent over serial to integer
-        except serial.SerialException: #Random wire errors
-            pass
-        sleep(up_power_interval)
+            reading = await dht_sampler.sample()
+            if reading != None: #If there has never been a good reading, keeps the default values
+                state.temp, state.humid = reading
+                request_render()
+            bounds = rule_engine.bounds('temp')
+            if bounds != None: #The sampler speeds up near the temperature range, so it needs a range rule to adapt to
+                dht_sampler.adapt(previous_temp, state.temp, bounds[0], bounds[1])
+        except Exception: #Same as run_every, an unexpected error only costs this reading
+            print('Error in update_values, trying again next interval:')
+            traceback.print_exc()
+        tick_stats.record(worker, loop.time() - tick_start, tick_start - next_time, dht_sampler.interval)
+        next_time = loop.time() + dht_sampler.interval
+        await asyncio.sleep(dht_sampler.interval)
+
+def setup_button(loop): #Attaches the button callbacks. gpiozero calls them from its own thread, so they only hand the event over to the loop
+    hw.button.when_held = lambda: loop.call_soon_threadsafe(on_button_held)
+    hw.button.when_released = lambda: loop.call_soon_threadsafe(on_button_released)
+
+def on_button_held(): #Called once the button has been held for hold_time. Toggles the display boolean. This does not disable the backlight, but the actual text.
+    state.button_held = True
+    if state.display == 1:
+        state.display = 0
+    else:
+        state.display = 1
+    print('Held, display = ' + str(state.display))
+    request_render()
+
+def on_button_released(): #Called when the button is let go. A short press cycles through the screens
+    if state.button_held: #If the press was a hold, the display was already toggled, so the screen stays the same
+        state.button_held = False
+        return
+    try:
+        state.screen = screen_list[state.screen + 1] #Tries to increase the screen value by 1
+    except IndexError:
+        state.screen = 0 #If screen value is at the highest value already, loops it back to 0
+    print('Pressed, screen = ' + str(state.screen))
+    request_render()
+
+async def check_conn(): #Used to monitor the internet connection
+    if link_manager.is_up(): #If ppp0 is up the connection is over the SIM, so keeps the last value given
+        return
+    state.conn_status = await conn_prober.probe()
+    if state.conn_status == 'disconnected':
+        state.conn = 0 #value of 0 indicates no connection
+    else:
+        state.conn = 1 #value of 1 indicates successful connection
+    request_render()
+
+async def check_power(): #Used to monitor the external power connection
+    try:
+        ups_parser.feed(hw.ups.read(hw.ups.in_waiting)) #UPS is set up as a serial device. Reads everything it has sent since the last check without blocking
+    except OSError: #Random wire errors. pyserial's SerialException is an OSError
+        return
+    if ups_parser.latest != None: #Acts on the newest frame only, so readings are never stale
+        if ups_parser.latest['Vin'] == 'GOOD': #If external power status is "GOOD"
+            state.pwr_status = 1 #pwr_status set to 1 indicates external power connection
+        else:
+            state.pwr_status = 0
+        state.bat_cap = ups_parser.latest['BATCAP'] #Battery capacity percentage
+        request_render()
     
-def output_values(): #Used to output values to terminal and to the LCD screen
+def screen_values(): #Values used to fill in the screen templates
+    if state.conn_status == 'degraded': #Connected, but slow or some targets are failing
+        conn_text = 'Degraded'
+    elif state.conn == 1:
+        conn_text = 'Connected'
+    else:
+        conn_text = 'Not Connected'
+    if state.pwr_status == 1:
+        pwr_text = 'Good'
+    else:
+        pwr_text = 'Bad'
+    return {'temp' : state.temp, 'humid' : state.humid, 'conn_text' : conn_text, 'pwr_text' : pwr_text, 'bat_cap' : state.bat_cap}
+
+def screen_lines(): #Lines the LCD should be showing for the current state
+    if state.display == 1: #If display is set to true.
+        values = screen_values()
+        return [template.format(**values) for template in screen_templates[state.screen]]
+    return ['', ''] #Blanks the screen if display is off. Only the characters still showing are written
+
+async def output_values(): #Used to output values to terminal and to the LCD screen. Redraws whenever request_render() is called instead of on a timer
+    global shown_lines
     while True:
-        if display.value == 1: #If display is set to true.
-            if screen.value == 0: #First screen, temp and humidity
-                lcd.text('Temp: ' + str(round(temp.value, 1)) + ' F', 1)
-                lcd.text('Hmd: ' + str(round(humid.value, 1)) + ' rH', 2)
-                print('Temp: ' + str(round(temp.value, 1)) + ' F | Humidity: ' + str(round(humid.value, 1)) + ' rH')
-            elif screen.value == 1: #Second screen, internet connection status
-                if conn.value == 1: #If internet connection bool is true
-                    print('Internet is connected.')
-                    lcd.text('Internet Status:', 1)
-                    lcd.text('Connected', 2)
-                else: #if internet connection bool is false
-                    print('No internet connection.')
-                    lcd.text('Internet Status:', 1)
-                    lcd.text('Not Connected', 2)
-            elif screen.value == 2: #Third screen, power status
-                if pwr_status.value == 1: #If external power bool is true
-                    lcd.text('PWR Status: Good', 1)
-                    print('PWR Status: Good | Battery: ' + str(bat_cap.value) + '%')
-                else:
-                    lcd.text('PWR Status: Bad', 1)
-                    print('PWR Status: Bad | Battery: ' + str(bat_cap.value) + '%')
-                lcd.text('Battery: ' + str(bat_cap.value) + '%', 2) #Second line indicates the battery percentage
-        else: #Clear the screen if display is off
-            lcd.clear()
-        sleep(up_screen_interval)
-
-def monitor_values(): #Used to check that the monitored values are where they should be.
-    while True: #Sends a message if the value that is being checked has failed 3 times.
-        for value_name in check_value_dict.keys(): #For all values to check
-            if check_value(value_name) == False: #If value fails the check
-                if check_value_dict[value_name][0] <= 2: #If value has failed the check less than 3 times in succession
-                    check_value_dict[value_name][0] += 1 #Increases failed check counter by 1
-                else: #If it has failed three times
-                    send_message(value_name) #Send the warning message for whatever value has failed
-                    check_value_dict[value_name][0] = -60 / monitor_interval * minute_interval + 4 #Monitor goes off every monitor_interval seconds, so this calculation changes the minute interval into second periods
-            else:
-                if check_value_dict[value_name][0] > 0:
-                    check_value_dict[value_name][0] = 0 #If monitor succeeds, sets the counter to 0.
-        sleep(monitor_interval)
-
-def pon_caller(): #Used to start pon.
-    while True: #Continuously checks whether pon_function.value is 1
-        if pon_function.value == 1: #If the value is set to 1, calls the function to start pon
-            start_pon() #start_pon sets the pon_function.value back to 0 at the end of it so a loop isn't created
-        
-        
-#Initializes and starts all of the multiprocesses
-update_value_func = multiprocessing.Process(target=update_values, args=(temp.value, humid.value))
-out_value_func = multiprocessing.Process(target=output_values)
-conn_func = multiprocessing.Process(target=check_conn)
-power_func = multiprocessing.Process(target=check_power)
-button_func = multiprocessing.Process(target=check_button)
-monitor_func = multiprocessing.Process(target=monitor_values)
-pon_func = multiprocessing.Process(target=pon_caller)
-
-update_value_func.start()
-out_value_func.start()
-conn_func.start()
-power_func.start()
-button_func.start()
-monitor_func.start()
-pon_func.start()
-
-#Keeps the program running and terminates all processes on Keyboard Interrupt. Also clears the lcd screen.
-while True:
-    try:
-        pass
-    except KeyboardInterrupt:
-       update_value_func.terminate()
-       out_value_func.terminate()
-       conn_func.terminate()
-       power_func.terminate()
-       button_func.terminate()
-       monitor_func.terminate()
-       pon_func.terminate()
-       lcd.clear()
-       exit()
\ No newline at end of file
+        await render_event.wait()
+        render_event.clear()
+        lines = screen_lines()
+        lcd_renderer.render(lines)
+        if lines != shown_lines and state.display == 1: #Prints to terminal only when the screen changes
+            print(' | '.join(lines))
+        shown_lines = lines
+
+async def record_history(): #Used to add the current values to the history
+    history.append(now(), [getattr(state, metric) for metric in history_metrics])
+
+async def flush_history(): #Used to write the history to the SD card in one batch
+    await run_blocking(history.write, history.changes())
+
+async def monitor_values(): #Used to check that the monitored values are where they should be.
+    results = rule_engine.evaluate(snapshot(), now())
+    counts = rule_engine.counts
+    for index, failed in enumerate(results): #Sends a message if a rule has failed alert_after_failures times in succession
+        name = rule_engine.rules[index].name
+        if failed: #If rule fails the check
+            alert_digest.failing(name)
+            if counts[index] < alert_after_failures: #If rule has failed the check less than alert_after_failures times in succession
+                counts[index] += 1 #Increases failed check counter by 1
+            else: #If it has failed enough times
+                alert_digest.add(name) #Adds the warning message for whatever rule has failed to the next digest
+                counts[index] = realert_count
+        else:
+            alert_digest.passing(name)
+            if counts[index] > 0:
+                counts[index] = 0 #If rule passes, sets the counter to 0.
+
+profiler = metrics.SamplingProfiler(profile_interval / 1000) #Only started when profile_interval is set
+
+def collect_metrics(): #Metric families published by the metrics endpoint, as (name, type, help, samples). Built on every scrape, so none of the tasks pay for it
+    def single(value):
+        return [({}, value)]
+    workers = [({'worker' : name}, index) for index, name in enumerate(tick_stats.names)]
+    families = [
+        ('server_monitor_temperature_fahrenheit', 'gauge', 'Room temperature', single(state.temp)),
+        ('server_monitor_humidity_percent', 'gauge', 'Room humidity in rH', single(state.humid)),
+        ('server_monitor_battery_percent', 'gauge', 'UPS battery capacity', single(state.bat_cap)),
+        ('server_monitor_external_power', 'gauge', '1 if external power is connected', single(state.pwr_status)),
+        ('server_monitor_internet_connected', 'gauge', '1 if the internet is connected', single(state.conn)),
+        ('server_monitor_internet_status', 'gauge', '1 for the current internet status', [({'status' : status}, int(state.conn_status == status)) for status in ('connected', 'degraded', 'disconnected')]),
+        ('server_monitor_rule_failing', 'gauge', '1 if the rule failed its last check', [({'rule' : rule.name}, int(failing)) for rule, failing in zip(rule_engine.rules, rule_engine.failing)]),
+        ('server_monitor_dht_reads_total', 'counter', 'Physical DHT reads attempted', single(dht_sampler.reads)),
+        ('server_monitor_dht_read_failures_total', 'counter', 'Physical DHT reads that failed', single(dht_sampler.failures)),
+        ('server_monitor_dht_failure_ratio', 'gauge', 'Fraction of DHT reads that failed since startup', single(1 - dht_sampler.success_rate() / 100)),
+        ('server_monitor_dht_read_seconds_total', 'counter', 'Seconds spent in physical DHT reads', single(dht_sampler.total_latency)),
+        ('server_monitor_dht_last_read_seconds', 'gauge', 'Seconds the last physical DHT read took', single(dht_sampler.last_latency)),
+        ('server_monitor_dht_interval_seconds', 'gauge', 'Current adaptive DHT sampling interval', single(dht_sampler.interval)),
+        ('server_monitor_ups_frames_total', 'counter', 'Good UPS frames parsed', single(ups_parser.frames)),
+        ('server_monitor_ups_frame_errors_total', 'counter', 'Malformed UPS frames thrown away', single(ups_parser.frame_errors)),
+        ('server_monitor_ups_bytes_read_total', 'counter', 'Bytes read from the UPS', single(ups_parser.bytes_read)),
+        ('server_monitor_probes_total', 'counter', 'Internet connection probes run', single(conn_prober.probes)),
+        ('server_monitor_probe_cpu_seconds_total', 'counter', 'CPU seconds spent probing the internet connection', single(conn_prober.total_cost)),
+        ('server_monitor_probe_rtt_seconds', 'gauge', 'Round trip time of the last successful connection to each target', [({'target' : host + ':' + str(port)}, rtts[-1]) for (host, port), rtts in conn_prober.rtts.items() if len(rtts) > 0 and rtts[-1] != None]),
+        ('server_monitor_probe_average_rtt_seconds', 'gauge', 'Average round trip time to each target over the rolling window', [({'target' : host + ':' + str(port)}, conn_prober.average_rtt((host, port))) for host, port in conn_prober.targets]),
+        ('server_monitor_tick_total', 'counter', 'Ticks run by each periodic task', [(labels, tick_stats.value(worker, 'ticks')) for labels, worker in workers]),
+        ('server_monitor_tick_seconds_total', 'counter', 'Seconds spent in the ticks of each periodic task', [(labels, tick_stats.value(worker, 'seconds')) for labels, worker in workers]),
+        ('server_monitor_tick_max_seconds', 'gauge', 'Longest tick of each periodic task', [(labels, tick_stats.value(worker, 'max_seconds')) for labels, worker in workers]),
+        ('server_monitor_tick_overruns_total', 'counter', 'Ticks that took longer than the task interval', [(labels, tick_stats.value(worker, 'overruns')) for labels, worker in workers]),
+        ('server_monitor_tick_lag_seconds_total', 'counter', 'Seconds the ticks of each periodic task started late', [(labels, tick_stats.value(worker, 'lag_seconds')) for labels, worker in workers]),
+        ('server_monitor_tick_max_lag_seconds', 'gauge', 'Latest start of a tick of each periodic task', [(labels, tick_stats.value(worker, 'max_lag_seconds')) for labels, worker in workers]),
+        ('server_monitor_tick_interval_seconds', 'gauge', 'Interval of each periodic task', [(labels, tick_stats.intervals[worker]) for labels, worker in workers]),
+        ('server_monitor_alert_queue_depth', 'gauge', 'Alerts waiting to be sent', single(len(alert_queue.pending))),
+        ('server_monitor_alerts_delivered_total', 'counter', 'Alerts sent to every phone number', single(alert_queue.delivered)),
+        ('server_monitor_alerts_dropped_total', 'counter', 'Alerts dropped because the queue was full', single(alert_queue.dropped)),
+        ('server_monitor_alerts_suppressed_total', 'counter', 'Repeat alerts held back because the condition had not got worse', single(alert_digest.suppressed)),
+        ('server_monitor_alerts_given_up_total', 'counter', 'Alerts that failed after every retry', single(alert_queue.given_up)),
+        ('server_monitor_alert_latency_seconds_total', 'counter', 'Seconds from queueing to sending for all delivered alerts', single(alert_queue.total_latency)),
+        ('server_monitor_alert_last_latency_seconds', 'gauge', 'Seconds from queueing to sending for the last delivered alert', single(alert_queue.last_latency)),
+        ('server_monitor_sim_link_up', 'gauge', '1 if the SIM connection is up', single(int(link_manager.is_up()))),
+        ('server_monitor_sim_sessions_total', 'counter', 'Finished SIM connection sessions', single(link_manager.sessions)),
+        ('server_monitor_lcd_bytes_written_total', 'counter', 'Bytes sent to the LCD', single(lcd_renderer.bytes_written)),
+        ('server_monitor_history_appends_total', 'counter', 'Samples added to the history', single(history.appends)),
+        ('server_monitor_history_dropped_total', 'counter', 'History entries thrown away because the clock went backwards', single(history.dropped())),
+        ('server_monitor_profiler_samples_total', 'counter', 'Samples taken by the sampling profiler', single(profiler.samples))]
+    if ups_parser.latest_time != None:
+        families.append(('server_monitor_ups_frame_age_seconds', 'gauge', 'Seconds since the last good UPS frame', single(now() - ups_parser.latest_time)))
+    cpu, rss, max_rss = metrics.process_usage()
+    families.append(('process_cpu_seconds_total', 'counter', 'User and system CPU time', single(cpu)))
+    families.append(('process_resident_memory_bytes', 'gauge', 'Resident memory size', single(rss)))
+    families.append(('process_max_resident_memory_bytes', 'gauge', 'Peak resident memory size', single(max_rss)))
+    return families
+
+metrics_server = metrics.MetricsServer(collect_metrics, profiler)
+
+def setup(hardware): #Opens the files and starts the parts of the monitor that use the devices. Kept out of import, so importing this file opens nothing
+    global hw, dht_sampler, lcd_renderer, history, alert_queue, render_event
+    hw = hardware
+    render_event = asyncio.Event() #Before Python 3.10 an Event is tied to the loop that is current when it is made, so this has to run on the monitor's loop
+    dht_sampler = DHTSampler(hw.dht, up_env_interval, up_env_max_interval, dht_median_samples, dht_retries)
+    lcd_renderer = LCDRenderer(hw.lcd)
+    history = HistoryStore(history_file, history_raw_slots, history_minute_slots, history_hour_slots)
+    alert_queue = AlertQueue(alert_journal, alert_queue_size)
+
+async def run_monitor(stop_event): #Starts all of the tasks on the running event loop and runs them until stop_event is set
+    global wall_clock_offset
+    loop = asyncio.get_running_loop()
+    wall_clock_offset = time() - loop.time()
+    setup_button(loop)
+    request_render() #Draws the first screen
+    if profile_interval > 0:
+        profiler.start()
+    if metrics_port != 0:
+        try:
+            await metrics_server.start(metrics_host, metrics_port)
+        except OSError as e: #Port in use. The monitor matters more than its metrics, so it keeps running without them
+            print('Metrics endpoint could not start: ' + str(e))
+
+    tasks = [asyncio.create_task(update_values()),
+             asyncio.create_task(output_values()),
+             asyncio.create_task(run_every(up_conn_interval, check_conn)),
+             asyncio.create_task(run_every(up_power_interval, check_power)),
+             asyncio.create_task(run_every(monitor_interval, monitor_values)),
+             asyncio.create_task(dispatch_alerts()),
+             asyncio.create_task(run_every(history_interval, record_history)),
+             asyncio.create_task(run_every(history_flush_interval, flush_history))]
+
+    await stop_event.wait()
+
+    #Cancels all of the tasks, takes down the SIM connection and clears the lcd screen.
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await metrics_server.stop()
+    if profiler.running:
+        profiler.stop()
+    if link_manager.idle_handle != None:
+        link_manager.idle_handle.cancel()
+    link_manager.leases = 0
+    await link_manager.take_down()
+    hw.button.when_held = None
+    hw.button.when_released = None
+    await alert_queue.saved() #Before the executor goes, since it does the write
+    executor.shutdown(wait=False, cancel_futures=True)
+    history.flush()
+    hw.lcd.clear()
+
+def print_stats(): #Reports how much the monitor cost to run
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    print('CPU time: ' + str(round(usage.ru_utime + usage.ru_stime, 2)) + ' s | Max RSS: ' + str(usage.ru_maxrss) + ' kB')
+    print('Alerts sent: ' + str(alert_queue.delivered) + ' | Unsent: ' + str(len(alert_queue.pending)) + ' | Average latency: ' + str(round(alert_queue.average_latency(), 1)) + ' s')
+    print('SIM sessions: ' + str(link_manager.sessions) + ' | Average bring up: ' + str(round(link_manager.average_bring_up(), 1)) + ' s | Average session: ' + str(round(link_manager.average_session(), 1)) + ' s')
+    print('Connection probes: ' + str(conn_prober.probes) + ' | Average RTT: ' + str(round(conn_prober.average_rtt() * 1000, 1)) + ' ms | Average probe CPU: ' + str(round(conn_prober.average_cost() * 1000, 2)) + ' ms')
+    print('UPS frames: ' + str(ups_parser.frames) + ' | Frame errors: ' + str(ups_parser.frame_errors) + ' | Bytes read: ' + str(ups_parser.bytes_read))
+    print('LCD bytes written: ' + str(lcd_renderer.bytes_written))
+    print('History samples: ' + str(history.appends) + ' | Dropped: ' + str(history.dropped()) + ' | Average append: ' + str(round(history.average_append() * 1000000, 1)) + ' us')
+    print('DHT reads: ' + str(dht_sampler.reads) + ' | Success rate: ' + str(round(dht_sampler.success_rate(), 1)) + '% | Average latency: ' + str(round(dht_sampler.average_latency() * 1000, 1)) + ' ms')
+    print('Tick overruns: ' + ', '.join(name + ' ' + str(int(tick_stats.value(worker, 'overruns'))) + ' (max lag ' + str(round(tick_stats.value(worker, 'max_lag_seconds') * 1000, 1)) + ' ms)' for worker, name in enumerate(tick_stats.names)))
+
+
+async def main(): #Opens the devices and runs the monitor until SIGINT or SIGTERM
+    if simulate == True:
+        setup(devices.open_simulated_devices())
+    else:
+        setup(devices.open_real_devices(config))
+    print('Started in ' + str(round((perf_counter() - start_time) * 1000)) + ' ms')
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM): #Ctrl+C and systemd stop both shut down cleanly
+        loop.add_signal_handler(sig, stop_event.set)
+    await run_monitor(stop_event)
+    print_stats()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,176 @@
+#Metrics endpoint for the monitor. Serves the monitored values and the monitor's own timings over HTTP, in the Prometheus text format or as JSON.
+#Scrape /metrics with Prometheus, or fetch /metrics?format=json. /profile returns the sampling profiler's stacks when it is turned on.
+#The only thing here on the monitor's hot path is TickStats.record(), which writes into a preallocated array so recording a tick never allocates.
+
+import asyncio
+import json
+import os
+import resource
+import signal
+from array import array
+from collections import Counter
+
+request_timeout = 5 #Seconds a client gets to send its request before the connection is dropped
+
+class TickStats: #Timings for every periodic worker. Each worker gets a fixed block of the values array when it starts, and every tick only adds into its block
+    fields = ('ticks', 'seconds', 'max_seconds', 'overruns', 'lag_seconds', 'max_lag_seconds') #Layout of each worker's block
+    width = len(fields)
+    #ticks is the number of ticks run. seconds and max_seconds are how long they took. overruns is how many took longer than the interval
+    #lag_seconds and max_lag_seconds are how late the ticks started, which is how long something else was blocking the event loop
+
+    def __init__(self):
+        self.names = [] #Worker names, in the order they were added
+        self.intervals = array('d') #Interval of each worker. Adaptive workers update theirs every tick
+        self.values = array('d') #One block of len(fields) values per worker
+
+    def add(self, name, interval): #Adds a worker and returns its index for record(). A worker that is started again keeps its block
+        if name in self.names:
+            return self.names.index(name)
+        self.names.append(name)
+        self.intervals.append(interval)
+        self.values.extend([0.0] * self.width)
+        return len(self.names) - 1
+
+    def record(self, worker, duration, lag, interval): #Records one tick. Runs after every tick, so it only writes numbers into the arrays
+        base = worker * self.width
+        values = self.values
+        values[base] += 1
+        values[base + 1] += duration
+        if duration > values[base + 2]:
+            values[base + 2] = duration
+        if duration > interval:
+            values[base + 3] += 1
+        values[base + 4] += lag
+        if lag > values[base + 5]:
+            values[base + 5] = lag
+        self.intervals[worker] = interval
+
+    def value(self, worker, field): #One value from a worker's block
+        return self.values[worker * self.width + self.fields.index(field)]
+
+class SamplingProfiler: #Opt-in sampling profiler. Every interval seconds of CPU time the process uses, counts the Python stack that was running
+    #Uses the profiling timer, so it only samples while the monitor is busy and costs nothing while it is waiting on the loop.
+    #Signal handlers run in the main thread, so CPU used by the executor threads is counted against whatever the loop was doing at the time
+    max_depth = 32 #Deepest stack recorded. Deeper frames are left off the root end
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter() #Samples for each stack, in the collapsed format flamegraph.pl reads
+        self.samples = 0
+        self.running = False
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.running = False
+
+    def sample(self, signum, frame): #Signal handler. Records the stack from the outermost frame in
+        names = []
+        while frame != None and len(names) < self.max_depth:
+            names.append(os.path.basename(frame.f_code.co_filename) + ':' + frame.f_code.co_name)
+            frame = frame.f_back
+        names.reverse()
+        self.stacks[';'.join(names)] += 1
+        self.samples += 1
+
+    def collapsed(self, limit=None): #Stacks with their sample counts, most sampled first. One "stack count" line each
+        return '\n'.join(stack + ' ' + str(count) for stack, count in self.stacks.most_common(limit)) + '\n'
+
+def process_usage(): #Returns (CPU seconds, resident memory in bytes, peak resident memory in bytes) for the monitor process
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    rss = 0
+    try:
+        with open('/proc/self/statm') as statm: #Current RSS. getrusage only has the peak
+            rss = int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError): #Not Linux
+        pass
+    return (usage.ru_utime + usage.ru_stime, rss, usage.ru_maxrss * 1024) #ru_maxrss is in kB on Linux
+
+def format_value(value): #Formats a sample value the way the Prometheus text format expects
+    if isinstance(value, bool) or isinstance(value, int):
+        return str(int(value))
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(float(value))
+
+def format_labels(labels): #Formats labels like {target="8.8.8.8:53"}
+    if len(labels) == 0:
+        return ''
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(name + '="' + value + '"')
+    return '{' + ','.join(pairs) + '}'
+
+def to_text(families): #Prometheus text format. families is a list of (name, type, help, samples) and samples is a list of (labels, value)
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append('# HELP ' + name + ' ' + help_text)
+        lines.append('# TYPE ' + name + ' ' + kind)
+        for labels, value in samples:
+            lines.append(name + format_labels(labels) + ' ' + format_value(value))
+    return '\n'.join(lines) + '\n'
+
+def to_json(families): #JSON object of metric name to value. Metrics with labels are a list of their labels with a value field added
+    result = {}
+    for name, kind, help_text, samples in families:
+        if len(samples) == 1 and len(samples[0][0]) == 0:
+            result[name] = samples[0][1]
+        else:
+            result[name] = [dict(labels, value=value) for labels, value in samples]
+    return json.dumps(result, indent=1)
+
+class MetricsServer: #Small HTTP server for the metrics. Runs on the monitor's event loop and answers one request per connection
+    def __init__(self, collect, profiler):
+        self.collect = collect #Called on every scrape. Returns the metric families
+        self.profiler = profiler
+        self.server = None
+        self.scrapes = 0 #Number of requests answered
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port)
+
+    async def stop(self):
+        if self.server != None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer): #Answers one request and closes the connection
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), request_timeout)
+            request_line = request.split(b'\r\n', 1)[0].decode('ascii').split(' ')
+            method = request_line[0]
+            path, _, query = request_line[1].partition('?')
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, UnicodeDecodeError, IndexError): #Client was too slow, hung up or sent garbage
+            writer.close()
+            return
+        if method != 'GET':
+            status, content_type, body = '405 Method Not Allowed', 'text/plain', 'Only GET is supported\n'
+        elif path == '/metrics' and query == 'format=json':
+            status, content_type, body = '200 OK', 'application/json', to_json(self.collect())
+        elif path == '/metrics':
+            status, content_type, body = '200 OK', 'text/plain; version=0.0.4; charset=utf-8', to_text(self.collect())
+        elif path == '/profile':
+            if self.profiler.running:
+                status, content_type, body = '200 OK', 'text/plain', self.profiler.collapsed()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', 'Profiler is off. Set profile_interval in the config to turn it on\n'
+        else:
+            status, content_type, body = '404 Not Found', 'text/plain', 'Try /metrics, /metrics?format=json or /profile\n'
+        body = body.encode('utf-8')
+        header = 'HTTP/1.0 ' + status + '\r\nContent-Type: ' + content_type + '\r\nContent-Length: ' + str(len(body)) + '\r\nConnection: close\r\n\r\n'
+        try:
+            writer.write(header.encode('ascii') + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+        self.scrapes += 1
@@ -0,0 +1,235 @@
+#Replays a recorded or synthetic trace through the monitor on simulated devices, faster than real time.
+#Reports startup time, CPU time per simulated hour and how long alerts took from the condition starting to the message being sent.
+#Run from the repo directory so setup.conf is found:
+#  python replay.py --days 3
+#  python replay.py --trace trace.csv
+#A trace is a CSV file with the columns seconds, temp_f, humid, vin_good, batcap, conn. conn is connected, degraded or disconnected.
+#Run with --save trace.csv to write the synthetic trace out, to edit or replay later.
+
+from time import perf_counter
+start_time = perf_counter()
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import csv
+import io
+import math
+import os
+import random
+import selectors
+import tempfile
+from time import process_time
+
+import devices
+import main
+import metrics
+
+import_time = perf_counter() - start_time
+
+class FastForwardSelector: #Wraps the event loop's selector. Whenever the loop would sleep until its next timer, the clock skips ahead instead
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.skipped = 0.0 #Seconds the clock has skipped ahead
+
+    def select(self, timeout=None):
+        if timeout == None: #Nothing is scheduled, so waits for real IO
+            return self.selector.select(None)
+        events = self.selector.select(0)
+        if len(events) == 0 and timeout > 0:
+            self.skipped += timeout
+        return events
+
+    def __getattr__(self, name): #Everything else goes to the real selector
+        return getattr(self.selector, name)
+
+class FastForwardLoop(asyncio.SelectorEventLoop): #Event loop whose clock runs as fast as the monitor can keep up with
+    def __init__(self):
+        self.fast_forward = FastForwardSelector()
+        super().__init__(self.fast_forward)
+
+    def time(self):
+        return super().time() + self.fast_forward.skipped
+
+class InlineExecutor(concurrent.futures.Executor): #Runs "blocking" calls right away. The simulated devices never block, and threads would let the clock skip ahead mid-call
+    def submit(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+class ScriptedProber(main.ConnProber): #Connection prober that reports the connection status from the trace instead of opening sockets
+    def __init__(self):
+        super().__init__([('trace', 0)], 1, 0, main.check_degraded_rtt, main.check_history)
+        self.status = 'connected'
+
+    async def probe(self):
+        self.probes += 1
+        return self.status
+
+def synthetic_trace(days, step, seed): #Builds a trace with a daily temperature swing, an air conditioning failure, a power outage that also takes the internet down, and a flaky internet hour
+    rng = random.Random(seed)
+    rows = []
+    battery = 100.0
+    for seconds in range(0, int(days * 86400), step):
+        day = seconds / 86400
+        hour = (seconds % 86400) / 3600
+        temp = 68 + 2 * math.sin(2 * math.pi * (hour - 9) / 24) + rng.gauss(0, 0.1)
+        humid = 45 + 3 * math.sin(2 * math.pi * hour / 24) + rng.gauss(0, 0.3)
+        vin_good = True
+        conn = 'connected'
+        if int(day) % 3 == 1 and 14 <= hour < 18: #Air conditioning fails, the room heats up for 2 hours and cools back down
+            temp += 8 * min(hour - 14, 18 - hour)
+        if int(day) % 3 == 2 and 3 <= hour < 3.75: #Power outage. The router goes down with it
+            vin_good = False
+            conn = 'disconnected'
+        if int(day) % 3 == 0 and day >= 1 and 20 <= hour < 21: #Flaky internet
+            conn = rng.choice(['connected', 'degraded', 'disconnected'])
+        if vin_good:
+            battery = min(100.0, battery + step / 360)
+        else:
+            battery = max(0.0, battery - step / 60)
+        rows.append({'seconds' : seconds, 'temp_f' : round(temp, 2), 'humid' : round(humid, 2), 'vin_good' : int(vin_good), 'batcap' : int(battery), 'conn' : conn})
+    return rows
+
+def read_trace(path): #Reads a trace CSV file
+    with open(path, newline='') as trace_file:
+        return [{'seconds' : float(row['seconds']), 'temp_f' : float(row['temp_f']), 'humid' : float(row['humid']),
+                 'vin_good' : int(row['vin_good']), 'batcap' : int(row['batcap']), 'conn' : row['conn']} for row in csv.DictReader(trace_file)]
+
+def write_trace(path, rows): #Writes a trace CSV file
+    with open(path, 'w', newline='') as trace_file:
+        writer = csv.DictWriter(trace_file, ['seconds', 'temp_f', 'humid', 'vin_good', 'batcap', 'conn'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+def failing_conditions(row): #Names of the conditions failing in a trace row, used to find when each one started
+    failing = set()
+    for metric, value in (('temp', row['temp_f']), ('humid', row['humid'])):
+        bounds = main.rule_engine.bounds(metric)
+        if bounds != None and not (bounds[0] <= value <= bounds[1]):
+            failing.add(metric)
+    if not row['vin_good']:
+        failing.add('power')
+    if row['conn'] == 'disconnected':
+        failing.add('internet')
+    return failing
+
+async def feed_trace(rows, hardware, prober, onsets, dht_fail_rate, seed): #Plays the trace rows into the simulated devices at their times. Records when each condition starts and clears
+    rng = random.Random(seed)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    failing = set()
+    for row in rows:
+        await asyncio.sleep(max(0, start + row['seconds'] - loop.time()))
+        hardware.dht.set((row['temp_f'] - 32) / 1.8, row['humid'], failing=rng.random() < dht_fail_rate)
+        hardware.ups.send(row['vin_good'], row['batcap'])
+        prober.status = row['conn']
+        now_failing = failing_conditions(row)
+        for condition in now_failing - failing:
+            onsets.append([main.now(), condition, None])
+        for onset in onsets:
+            if onset[2] == None and onset[1] in failing - now_failing: #Condition cleared
+                onset[2] = main.now()
+        failing = now_failing
+
+async def replay(rows, hardware, prober, dht_fail_rate, seed): #Runs the monitor until the trace is over. Returns [start, condition, end] for every condition in the trace
+    onsets = []
+    stop_event = asyncio.Event()
+    monitor = asyncio.create_task(main.run_monitor(stop_event))
+    await feed_trace(rows, hardware, prober, onsets, dht_fail_rate, seed)
+    await asyncio.sleep(main.alert_digest_window + main.monitor_interval * (main.alert_after_failures + 2)) #Gives alerts for conditions at the end of the trace time to go out
+    stop_event.set()
+    await monitor
+    return onsets
+
+def alert_latencies(onsets, sent): #Seconds from each condition starting to the first message sent after it
+    send_times = sorted(send_time for send_time, to, body in sent)
+    shortest = (main.alert_after_failures + 1) * main.monitor_interval #A condition has to fail this many checks in a row to be alerted on
+    episodes = {} #Condition name to [start, end] of its latest episode
+    starts = []
+    for onset, condition, end in onsets: #A condition that comes back within minute_interval of clearing, like a temperature hovering at the limit, is one episode
+        episode = episodes.get(condition)
+        if episode != None and episode[1] != None and onset - episode[1] < main.minute_interval * 60:
+            episode[1] = end
+            continue
+        episode = [onset, end]
+        episodes[condition] = episode
+        starts.append(episode)
+    latencies = []
+    for start, end in starts:
+        if end != None and end - start < shortest: #Cleared too soon to be alerted on
+            continue
+        later = [send_time for send_time in send_times if send_time >= start]
+        if len(later) > 0:
+            latencies.append(later[0] - start)
+    return latencies
+
+def run(args):
+    if args.trace != None:
+        rows = read_trace(args.trace)
+    else:
+        rows = synthetic_trace(args.days, args.step, args.seed)
+    if args.save != None:
+        write_trace(args.save, rows)
+        print('Wrote ' + str(len(rows)) + ' rows to ' + args.save)
+
+    with tempfile.TemporaryDirectory() as data_dir: #Keeps the replay's history and alert journal away from the real ones
+        main.history_file = os.path.join(data_dir, 'history.bin')
+        main.alert_journal = os.path.join(data_dir, 'alert_journal.json')
+        main.debug = False #Messages go to the fake SMS sink instead of the terminal
+        main.metrics_port = 0 #The replay reports its own numbers, and shouldn't take the port from a monitor running on the same machine
+        main.profile_interval = args.profile
+        main.profiler = metrics.SamplingProfiler(args.profile / 1000)
+        main.metrics_server.profiler = main.profiler
+        main.executor = InlineExecutor()
+        main.link_manager = main.LinkManager(data_dir, 'true', 'true', main.link_up_timeout, main.link_idle_timeout, True)
+        prober = ScriptedProber()
+        main.conn_prober = prober
+
+        loop = FastForwardLoop()
+        asyncio.set_event_loop(loop)
+        setup_start = perf_counter()
+        hardware = devices.open_simulated_devices(main.now)
+        main.setup(hardware)
+        setup_time = perf_counter() - setup_start
+
+        real_start = perf_counter()
+        cpu_start = process_time()
+        with contextlib.redirect_stdout(io.StringIO()) as monitor_output: #The monitor prints every screen change, which is too much for a replay
+            onsets = loop.run_until_complete(replay(rows, hardware, prober, args.dht_fail_rate, args.seed))
+        cpu_time = process_time() - cpu_start
+        real_time = perf_counter() - real_start
+        loop.close()
+
+    hours = (rows[-1]['seconds'] - rows[0]['seconds']) / 3600
+    latencies = alert_latencies(onsets, hardware.sms.sent)
+    print('Replayed ' + str(round(hours, 1)) + ' h in ' + str(round(real_time, 2)) + ' s (' + str(round(hours * 3600 / real_time)) + 'x real time)')
+    print('Startup: import ' + str(round(import_time * 1000, 1)) + ' ms | setup ' + str(round(setup_time * 1000, 1)) + ' ms')
+    print('CPU per simulated hour: ' + str(round(cpu_time / hours * 1000, 1)) + ' ms')
+    print('Conditions: ' + str(len(onsets)) + ' | Messages sent: ' + str(len(hardware.sms.sent)) + ' | Repeats held back: ' + str(main.alert_digest.suppressed) + ' | LCD bytes written: ' + str(hardware.lcd.bytes_written))
+    print('Tick overruns: ' + str(int(sum(main.tick_stats.value(worker, 'overruns') for worker in range(len(main.tick_stats.names))))) + ' | Max tick: ' + str(round(max(main.tick_stats.value(worker, 'max_seconds') for worker in range(len(main.tick_stats.names))), 2)) + ' s')
+    if len(latencies) > 0:
+        print('Alert latency: average ' + str(round(sum(latencies) / len(latencies), 1)) + ' s | max ' + str(round(max(latencies), 1)) + ' s')
+    if args.profile > 0:
+        print('Top stacks out of ' + str(main.profiler.samples) + ' samples:')
+        print(main.profiler.collapsed(10))
+    if args.verbose:
+        print(monitor_output.getvalue())
+        for send_time, to, body in hardware.sms.sent:
+            print('--- ' + to + ' at ' + str(round(send_time - main.wall_clock_offset)) + ' s\n' + body)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a trace through the monitor faster than real time.')
+    parser.add_argument('--trace', help='CSV trace to replay. Without it a synthetic trace is used')
+    parser.add_argument('--days', type=float, default=3, help='Length of the synthetic trace in days')
+    parser.add_argument('--step', type=int, default=10, help='Seconds between rows of the synthetic trace')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the synthetic trace and DHT failures')
+    parser.add_argument('--dht-fail-rate', type=float, default=0.02, help='Fraction of DHT reads that fail')
+    parser.add_argument('--save', help='Write the trace to this CSV file')
+    parser.add_argument('--profile', type=int, default=0, help='Run the sampling profiler with this many milliseconds of CPU time between samples and print the top stacks')
+    parser.add_argument('--verbose', action='store_true', help='Print the monitor output and every message sent')
+    run(parser.parse_args())
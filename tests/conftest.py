@@ -0,0 +1,8 @@
+#Lets the tests import the monitor's modules. main.py reads setup.conf from the working directory, so the tests run from the repo directory
+
+import os
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+os.chdir(repo_dir)
@@ -0,0 +1,65 @@
+#Local stand-in for the Twilio Messages API, for tests. Answers POST /2010-04-01/Accounts/<sid>/Messages.json like Twilio does and keeps every message
+#Runs in its own thread, since the monitor's Twilio calls block in the executor
+
+import json
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import parse_qs, urlencode
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        fake = self.server.fake
+        form = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        to = form['To'][0]
+        sleep(fake.delay)
+        with fake.lock:
+            fake.requests += 1
+            failures = fake.failing.get(to, 0)
+            if failures > 0:
+                fake.failing[to] = failures - 1
+            else:
+                fake.messages.append((to, form['From'][0], form['Body'][0]))
+        if failures > 0:
+            self.reply(400, {'code' : 21211, 'message' : "The 'To' number " + to + ' is not a valid phone number.', 'status' : 400})
+        else:
+            self.reply(201, {'sid' : 'SM' + str(len(fake.messages)).zfill(32), 'to' : to, 'from' : form['From'][0], 'body' : form['Body'][0], 'status' : 'queued'})
+
+    def reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): #Keeps the test output quiet
+        pass
+
+class FakeTwilio:
+    def __init__(self):
+        self.messages = [] #(to, from, body) for every message accepted
+        self.failing = {} #Phone number to how many more requests for it are answered with an error
+        self.delay = 0.0 #Seconds to wait before answering each request, like the real API's latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.fake = self
+        self.url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class Client: #Just enough of twilio.rest.Client for the monitor, so the tests don't need the Twilio SDK: messages.create() posts to the fake
+    def __init__(self, url, account_sid):
+        self.url = url + '/2010-04-01/Accounts/' + account_sid + '/Messages.json'
+        self.messages = self
+
+    def create(self, body, from_, to): #Raises urllib.error.HTTPError for an error response, like the SDK raises TwilioRestException
+        data = urlencode({'Body' : body, 'From' : from_, 'To' : to}).encode('utf-8')
+        with urllib.request.urlopen(urllib.request.Request(self.url, data=data), timeout=5) as response:
+            return json.load(response)
@@ -0,0 +1,173 @@
+import asyncio
+import json
+from time import perf_counter, sleep
+
+import pytest
+
+import devices
+import main
+from fake_twilio import Client, FakeTwilio
+
+numbers = ['+15550000001', '+15550000002', '+15550000003']
+
+@pytest.fixture
+def twilio():
+    fake = FakeTwilio()
+    yield fake
+    fake.stop()
+
+@pytest.fixture
+def monitor(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, 'alert_list', numbers)
+    monkeypatch.setattr(main, 'debug', False)
+    monkeypatch.setattr(main, 'alert_retry_delay', 0.01)
+    monkeypatch.setattr(main, 'state', main.MonitorState()) #Connected, so alerts go straight out without the SIM connection
+    return tmp_path / 'alert_journal.json'
+
+def open_queue(monkeypatch, journal, maxsize=5): #Alert queue for the test. Made inside the running loop, since it holds an asyncio event
+    queue = main.AlertQueue(str(journal), maxsize)
+    monkeypatch.setattr(main, 'alert_queue', queue)
+    return queue
+
+async def dispatch_until(condition, timeout=5): #Runs the dispatcher until condition() is true. Fails if the dispatcher dies or it takes too long
+    task = asyncio.create_task(main.dispatch_alerts())
+    try:
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not condition():
+            if task.done():
+                task.result()
+                pytest.fail('Dispatcher stopped')
+            assert asyncio.get_running_loop().time() < deadline, 'Timed out waiting for the dispatcher'
+            await asyncio.sleep(0.01)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+def test_full_queue_never_drops_the_alert_being_sent(monitor, monkeypatch):
+    async def scenario():
+        queue = open_queue(monkeypatch, monitor, maxsize=1)
+        queue.put('first')
+        sending = await queue.get()
+        queue.put('second') #Full, but the first alert is being sent so it stays
+        queue.done(sending)
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert [alert['message'] for alert in queue.pending] == ['second']
+    assert queue.dropped == 0
+
+def test_full_queue_drops_the_oldest_waiting_alert(monitor, monkeypatch):
+    async def scenario():
+        queue = open_queue(monkeypatch, monitor, maxsize=2)
+        queue.put('first')
+        sending = await queue.get()
+        for message in ('second', 'third', 'fourth'):
+            queue.put(message)
+        return queue, sending
+
+    queue, sending = asyncio.run(scenario())
+    assert [alert['message'] for alert in queue.pending] == ['first', 'third', 'fourth']
+    assert queue.pending[0] is sending
+    assert queue.dropped == 1
+
+def test_journal_survives_a_restart(monitor, monkeypatch):
+    async def scenario():
+        queue = open_queue(monkeypatch, monitor)
+        queue.put('first')
+        queue.put('second')
+        queue.done(await queue.get())
+        await queue.saved() #The monitor waits for the journal write before it exits
+        restarted = open_queue(monkeypatch, monitor)
+        return restarted, await restarted.get()
+
+    restarted, alert = asyncio.run(scenario())
+    assert alert['message'] == 'second'
+    assert alert['recipients'] == numbers
+    assert len(restarted.pending) == 1
+    assert json.loads(monitor.read_text())[0]['message'] == 'second'
+
+def test_journal_is_written_off_the_loop(monitor, monkeypatch):
+    written = []
+    def slow_write(journal): #Like an fsync to a slow SD card
+        sleep(0.2)
+        written.append(json.loads(journal))
+    async def scenario():
+        queue = open_queue(monkeypatch, monitor)
+        monkeypatch.setattr(queue, 'write', slow_write)
+        queue.put('first')
+        await asyncio.sleep(0.05) #The first write is under way
+        start = perf_counter()
+        queue.put('second')
+        queue.put('third')
+        put_time = perf_counter() - start
+        await queue.saved()
+        return put_time
+
+    assert asyncio.run(scenario()) < 0.05
+    assert [[alert['message'] for alert in journal] for journal in written] == [['first'], ['first', 'second', 'third']] #Saves made during a write are combined, newest last
+
+def test_unreadable_journal_starts_over(monitor, monkeypatch):
+    monitor.write_text('[{"message": "cut off by a power lo')
+    async def scenario():
+        return open_queue(monkeypatch, monitor)
+
+    assert len(asyncio.run(scenario()).pending) == 0
+
+def test_alert_is_sent_to_every_number_at_once(monitor, monkeypatch, twilio):
+    twilio.delay = 0.2
+    monkeypatch.setattr(main, 'hw', devices.Devices(None, None, None, None, Client(twilio.url, 'ACtest')))
+    async def scenario():
+        queue = open_queue(monkeypatch, monitor)
+        queue.put('HQ SERVER ALERT\nRoom temperature is too hot.')
+        start = perf_counter()
+        await dispatch_until(lambda: queue.delivered == 1)
+        elapsed = perf_counter() - start
+        await queue.saved()
+        return queue, elapsed
+
+    queue, elapsed = asyncio.run(scenario())
+    assert sorted(to for to, from_, body in twilio.messages) == numbers
+    assert all(body == 'HQ SERVER ALERT\nRoom temperature is too hot.' for to, from_, body in twilio.messages)
+    assert elapsed < 2 * twilio.delay #Sent in parallel, one at a time would take 3 delays
+    assert 0 < queue.last_latency < 2 * twilio.delay
+    assert len(queue.pending) == 0
+    assert json.loads(monitor.read_text()) == []
+
+def test_only_failed_numbers_are_retried(monitor, monkeypatch, twilio):
+    twilio.failing[numbers[1]] = 2
+    monkeypatch.setattr(main, 'hw', devices.Devices(None, None, None, None, Client(twilio.url, 'ACtest')))
+    async def scenario():
+        queue = open_queue(monkeypatch, monitor)
+        queue.put('alert')
+        await dispatch_until(lambda: queue.delivered == 1)
+
+    asyncio.run(scenario())
+    assert sorted(to for to, from_, body in twilio.messages) == numbers #Each number got the alert once
+    assert twilio.requests == len(numbers) + 2
+
+def test_dispatcher_keeps_going_after_giving_up(monitor, monkeypatch, twilio):
+    twilio.failing[numbers[0]] = main.alert_retries + 1 #Fails the first alert on every try
+    monkeypatch.setattr(main, 'hw', devices.Devices(None, None, None, None, Client(twilio.url, 'ACtest')))
+    async def scenario():
+        queue = open_queue(monkeypatch, monitor)
+        queue.put('given up on')
+        queue.put('sent')
+        await dispatch_until(lambda: queue.delivered == 1)
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert queue.given_up == 1
+    assert (numbers[0], main.messenger_number, 'sent') in twilio.messages
+
+def test_twilio_sdk_talks_to_the_fake(monitor, monkeypatch, twilio):
+    rest = pytest.importorskip('twilio.rest')
+    client = rest.Client('ACtest', 'token')
+    client.api.base_url = twilio.url #The SDK builds every request URL from this
+    monkeypatch.setattr(main, 'hw', devices.Devices(None, None, None, None, client))
+    async def scenario():
+        queue = open_queue(monkeypatch, monitor)
+        queue.put('alert')
+        await dispatch_until(lambda: queue.delivered == 1)
+
+    asyncio.run(scenario())
+    assert len(twilio.messages) == len(numbers)
@@ -0,0 +1,89 @@
+#Drives the real gpiozero button on mock pins, the same way the hardware would, and checks the callbacks the monitor attaches to it
+
+import asyncio
+from time import perf_counter, process_time
+
+import pytest
+
+pytest.importorskip('gpiozero')
+from gpiozero import Device
+from gpiozero.pins.mock import MockFactory
+
+import devices
+import main
+
+hold_time = 0.2 #Shorter than the real 3 seconds so the tests run quickly
+press_time = 0.1 #Longer than the bounce time, shorter than hold_time
+
+@pytest.fixture
+def button(monkeypatch):
+    monkeypatch.setenv('GPIOZERO_PIN_FACTORY', 'mock')
+    Device.pin_factory = MockFactory()
+    button = devices.open_button(hold_time=hold_time)
+    monkeypatch.setattr(main, 'hw', devices.Devices(None, None, button, None, None))
+    monkeypatch.setattr(main, 'state', main.MonitorState())
+    yield button
+    button.close()
+    Device.pin_factory.reset()
+
+class PressTimer: #Wraps on_button_released to time how long each release takes to reach the loop
+    def __init__(self, monkeypatch):
+        self.released_at = None
+        self.latencies = []
+        self.handled = asyncio.Event()
+        self.on_button_released = main.on_button_released
+        monkeypatch.setattr(main, 'on_button_released', self.on_release)
+
+    def on_release(self):
+        self.on_button_released()
+        self.latencies.append(perf_counter() - self.released_at)
+        self.handled.set()
+
+    async def press(self, button, seconds): #Holds the button down for seconds, lets go and waits for the release to be handled
+        self.handled.clear()
+        button.pin.drive_low() #The button pulls the pin low when pressed
+        await asyncio.sleep(seconds)
+        self.released_at = perf_counter()
+        button.pin.drive_high()
+        await asyncio.wait_for(self.handled.wait(), 1)
+        await asyncio.sleep(press_time) #Waits out the bounce time before the next press
+
+async def attach(monkeypatch, button):
+    monkeypatch.setattr(main, 'render_event', asyncio.Event())
+    main.setup_button(asyncio.get_running_loop())
+    return PressTimer(monkeypatch)
+
+def test_short_press_cycles_screens(button, monkeypatch):
+    async def scenario():
+        timer = await attach(monkeypatch, button)
+        for press in range(len(main.screen_list)):
+            await timer.press(button, press_time)
+        return timer
+
+    timer = asyncio.run(scenario())
+    assert main.state.screen == 0 #Went through every screen and back to the first
+    assert main.state.display == 1
+    assert len(timer.latencies) == len(main.screen_list)
+    assert max(timer.latencies) < 0.05 #Released to handled on the loop
+
+def test_hold_toggles_display_without_changing_screen(button, monkeypatch):
+    async def scenario():
+        timer = await attach(monkeypatch, button)
+        await timer.press(button, hold_time * 2)
+        assert main.state.display == 0
+        assert main.state.screen == 0
+        await timer.press(button, hold_time * 2)
+        assert main.state.display == 1
+        await timer.press(button, press_time) #A short press after a hold still changes the screen
+        assert main.state.screen == 1
+
+    asyncio.run(scenario())
+
+def test_idle_button_uses_no_cpu(button, monkeypatch):
+    async def scenario():
+        await attach(monkeypatch, button)
+        start = process_time()
+        await asyncio.sleep(0.5)
+        return process_time() - start
+
+    assert asyncio.run(scenario()) < 0.05 #Edge triggered, so nothing polls the pin while it is idle
@@ -0,0 +1,35 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+import devices
+
+class Opener: #Counts how many times the device was opened
+    def __init__(self):
+        self.opened = 0
+
+    def __call__(self):
+        self.opened += 1
+        sleep(0.05) #Opening takes a while, like importing the Twilio SDK, so other threads pile up behind it
+        return devices.FakeSMS()
+
+def test_lazy_device_opens_on_first_use():
+    opener = Opener()
+    sms = devices.LazyDevice(opener)
+    assert opener.opened == 0
+    sms.messages.create(body='test', from_='+15550000000', to='+15550000001')
+    sms.messages.create(body='test', from_='+15550000000', to='+15550000002')
+    assert opener.opened == 1
+    assert len(sms.sent) == 2
+
+def test_lazy_device_opens_once_across_threads():
+    opener = Opener()
+    sms = devices.LazyDevice(opener)
+    start = threading.Barrier(8)
+    def send(index): #Like the first alert going to several phone numbers at once
+        start.wait()
+        sms.messages.create(body='test', from_='+15550000000', to='+1555000000' + str(index))
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(send, range(8)))
+    assert opener.opened == 1
+    assert len(sms.sent) == 8
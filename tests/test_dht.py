@@ -0,0 +1,48 @@
+import asyncio
+
+import devices
+import main
+
+class FlakyDHT(devices.ScriptedDHT): #Fails a set number of reads before returning the reading
+    def __init__(self, failures):
+        super().__init__(20.0, 45.0)
+        self.failures_left = failures
+
+    @property
+    def temperature(self):
+        if self.failures_left > 0:
+            self.failures_left -= 1
+            raise RuntimeError('Checksum did not validate. Try again.')
+        return self.celsius
+
+def sample(sampler):
+    return asyncio.run(sampler.sample())
+
+def test_median_filter_rejects_a_spike():
+    dht = devices.ScriptedDHT(20.0, 45.0)
+    sampler = main.DHTSampler(dht, 1, 30, 5, 0)
+    for celsius in (20.0, 20.0, 80.0, 20.0):
+        dht.set(celsius, 45.0)
+        reading = sample(sampler)
+    assert reading == (68.0, 45.0)
+    assert sampler.reads == 4
+
+def test_failed_read_is_retried(monkeypatch):
+    monkeypatch.setattr(main, 'dht_min_period', 0.01) #Backoff starts at dht_min_period
+    sampler = main.DHTSampler(FlakyDHT(2), 1, 30, 5, 2)
+    assert sample(sampler) == (68.0, 45.0)
+    assert sampler.reads == 3
+    assert sampler.failures == 2
+
+def test_no_reading_until_one_succeeds():
+    sampler = main.DHTSampler(devices.ScriptedDHT(), 1, 30, 5, 0)
+    sampler.device.set(20.0, 45.0, failing=True)
+    assert sample(sampler) == None
+    assert sampler.success_rate() == 0.0
+
+def test_interval_adapts_to_the_temperature():
+    sampler = main.DHTSampler(devices.ScriptedDHT(), 1, 30, 5, 0)
+    sampler.adapt(68.0, 68.0, 53.0, 75.0) #Stable in the middle of the range, slows down
+    assert sampler.interval == 2 * sampler.min_interval
+    sampler.adapt(68.0, 74.0, 53.0, 75.0) #Close to the high bound, as fast as possible
+    assert sampler.interval == sampler.min_interval
@@ -0,0 +1,78 @@
+import asyncio
+import configparser
+
+import pytest
+
+import main
+
+rules = '''
+[rule temp]
+metric = temp
+condition = range
+low = 53.0
+high = 75.0
+escalate = 2.0
+message = Temperature: _PLACEHOLDER_ F
+
+[rule power]
+metric = pwr_status
+condition = bool
+placeholder = bat_cap
+escalate = 20
+message = Battery: _PLACEHOLDER_%
+
+[rule internet]
+metric = conn
+condition = bool
+message = Internet down
+'''
+
+@pytest.fixture
+def digest(monkeypatch):
+    config = configparser.ConfigParser(interpolation=None)
+    config.read_string(rules)
+    monkeypatch.setattr(main, 'rule_engine', main.load_rules(config))
+    monkeypatch.setattr(main, 'state', main.MonitorState())
+    monkeypatch.setattr(main, 'minute_interval', 5)
+    monkeypatch.setattr(main, 'max_minute_interval', 40) #Back-off tops out at 8 re-alert chances
+    return main.AlertDigest(1000) #Long window, so the digest is never sent during a test
+
+def realerts(digest, name, values, metric): #Calls add() once per value, like monitor_values does every minute_interval. Returns which calls were let through
+    async def scenario():
+        sent = []
+        for value in values:
+            setattr(main.state, metric, value)
+            before = digest.suppressed
+            digest.failing(name) #monitor_values records the failure before alerting
+            digest.add(name)
+            sent.append(digest.suppressed == before)
+        digest.flush_handle.cancel()
+        return sent
+    return asyncio.run(scenario())
+
+def test_unchanged_condition_backs_off(digest):
+    sent = realerts(digest, 'internet', [0] * 24, 'conn')
+    assert [index + 1 for index, was_sent in enumerate(sent) if was_sent] == [1, 2, 4, 8, 16, 24] #Waits 1, 2, 4 and 8 intervals, then stays at the cap
+    assert digest.suppressed == 18
+
+def test_worse_value_is_sent_before_the_back_off_runs_out(digest):
+    sent = realerts(digest, 'temp', [80.0, 80.0, 80.5, 82.1, 82.5, 82.9], 'temp')
+    assert sent == [True, True, False, True, False, False] #82.1 is 2 F further out than the last alert, at 80.0
+
+def test_better_value_is_not_sent(digest):
+    sent = realerts(digest, 'temp', [85.0, 85.0, 80.0, 79.0], 'temp')
+    assert sent == [True, True, False, True] #Only the back-off lets the 4th one through
+
+def test_battery_draining_counts_as_worse(digest):
+    main.state.pwr_status = 0
+    sent = realerts(digest, 'power', [90, 85, 80, 64, 60], 'bat_cap')
+    assert sent == [True, True, False, True, False] #64 is 21 below the last alert at 85
+
+def test_recovery_starts_a_new_back_off(digest):
+    realerts(digest, 'internet', [0] * 4, 'conn')
+    async def recover():
+        main.state.conn = 1
+        digest.passing('internet')
+        digest.flush_handle.cancel()
+    asyncio.run(recover())
+    assert realerts(digest, 'internet', [0, 0, 0], 'conn') == [True, True, False]
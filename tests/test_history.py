@@ -0,0 +1,97 @@
+import random
+from bisect import bisect_left, bisect_right
+
+import main
+
+interval = main.history_interval
+
+def open_store(tmp_path, raw_slots=10, minute_slots=10, hour_slots=10):
+    return main.HistoryStore(str(tmp_path / 'history.bin'), raw_slots, minute_slots, hour_slots)
+
+def row(value): #One sample with every metric set to value
+    return [value] * len(main.history_metrics)
+
+def test_query_returns_the_window_oldest_first(tmp_path):
+    store = open_store(tmp_path)
+    for index in range(6):
+        store.append(1000 + index * interval, row(index))
+    rows = store.raw.query('temp', 1000 + interval, 1000 + 4 * interval)
+    assert rows == [(1000 + index * interval, float(index)) for index in range(1, 5)]
+    assert store.raw.query('temp', 0, 999) == []
+
+def test_minute_rollups(tmp_path):
+    store = open_store(tmp_path)
+    for second in range(0, 130, 10): #Two full minutes, then one sample into the third
+        store.append(6000 + second, row(second % 60))
+    assert store.minute.query('humid', 0, 10000) == [(6000, 0.0, 25.0, 50.0), (6060, 0.0, 25.0, 50.0)]
+
+def test_ring_keeps_the_newest_slots(tmp_path):
+    store = open_store(tmp_path, raw_slots=4)
+    for index in range(11):
+        store.append(1000 + index * interval, row(index))
+    assert [values[1] for values in store.raw.query('bat_cap', 0, 10000)] == [7.0, 8.0, 9.0, 10.0]
+
+def test_search_matches_bisect(tmp_path):
+    store = open_store(tmp_path, raw_slots=50)
+    random.seed(4)
+    times = sorted(random.choice(range(0, 400, 10)) for index in range(80)) #Repeats, and wraps the ring
+    for timestamp in times:
+        store.append(timestamp, row(0))
+    kept = times[-50:]
+    for timestamp in range(-5, 410, 5):
+        assert store.raw.search(timestamp, False) == bisect_left(kept, timestamp)
+        assert store.raw.search(timestamp, True) == bisect_right(kept, timestamp)
+
+def test_clock_going_back_drops_samples_until_it_catches_up(tmp_path):
+    store = open_store(tmp_path)
+    for index in range(5):
+        store.append(1000 + index * interval, row(index))
+    for index in range(3): #Restarted on a clock 3 samples behind
+        store.append(1000 + (index + 2) * interval - 1, row(-1))
+    store.append(1000 + 5 * interval, row(5))
+    times = [values[0] for values in store.raw.query('temp', 0, 10000)]
+    assert times == sorted(times)
+    assert len(times) == 6
+    assert store.raw.dropped == 3
+    assert store.raw.resets == 0
+
+def test_clock_going_back_past_the_tier_starts_it_over(tmp_path):
+    store = open_store(tmp_path)
+    for index in range(5):
+        store.append(10 ** 9 + index * interval, row(index))
+    store.append(1000, row(9)) #Restarted on a clock from years ago
+    assert store.raw.query('temp', 0, 2 * 10 ** 9) == [(1000, 9.0)]
+    assert store.raw.resets == 1
+    assert store.raw.dropped == 0
+
+def test_history_survives_a_restart(tmp_path, monkeypatch):
+    store = open_store(tmp_path)
+    for index in range(5):
+        store.append(1000 + index * interval, row(index))
+    store.flush()
+    reopened = open_store(tmp_path)
+    assert reopened.raw.query('temp', 0, 10000) == store.raw.query('temp', 0, 10000)
+    monkeypatch.setattr(main, 'now', lambda: 1000 + 4 * interval)
+    assert reopened.change('temp', 4 * interval) == 4.0
+
+def test_appends_only_reach_the_file_on_flush(tmp_path):
+    store = open_store(tmp_path, raw_slots=4)
+    path = tmp_path / 'history.bin'
+    store.flush()
+    flushed = path.read_bytes()
+    for index in range(3):
+        store.append(1000 + index * interval, row(index))
+    assert path.read_bytes() == flushed
+    store.flush()
+    assert path.read_bytes() == bytes(store.data)
+
+def test_flush_writes_runs_of_changed_slots(tmp_path):
+    store = open_store(tmp_path, raw_slots=4)
+    for index in range(3):
+        store.append(1000 + index * interval, row(index))
+    assert len(store.raw.changes()) == 2 #Slots 0 to 2, one write for the times and one for the values
+    for index in range(3, 5): #Slot 3, then slot 0 again once the ring wraps
+        store.append(1000 + index * interval, row(index))
+    changes = store.raw.changes()
+    assert [offset for offset, data in changes] == [store.raw.times_offset, store.raw.values_offset, store.raw.times_offset + 3 * 8, store.raw.values_offset + 3 * store.raw.width * 4]
+    assert store.raw.changes() == []
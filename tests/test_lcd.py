@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+import devices
+import main
+
+@pytest.fixture
+def panel(monkeypatch): #Monitor on a recording LCD and a fake UPS, with the power screen up
+    ups = devices.FakeUPS()
+    lcd = devices.RecordingLCD()
+    monkeypatch.setattr(main, 'hw', devices.Devices(None, lcd, None, ups, None))
+    monkeypatch.setattr(main, 'state', main.MonitorState())
+    monkeypatch.setattr(main, 'ups_parser', main.UPSParser(5))
+    monkeypatch.setattr(main, 'lcd_renderer', main.LCDRenderer(lcd))
+    monkeypatch.setattr(main, 'shown_lines', None)
+    main.state.screen = 2
+    return ups
+
+def test_renderer_only_writes_changes():
+    lcd = devices.RecordingLCD()
+    renderer = main.LCDRenderer(lcd)
+    renderer.render(['PWR Status: Good', 'Battery: 100%'])
+    written = renderer.bytes_written
+    renderer.render(['PWR Status: Good', 'Battery: 100%'])
+    assert renderer.bytes_written == written
+    renderer.render(['PWR Status: Good', 'Battery: 900%'])
+    assert renderer.bytes_written == written + 2 #One cursor move and one character
+    assert ''.join(lcd.screen.get(0x40 + column, ' ') for column in range(13)) == 'Battery: 900%' #Spaces already on the blank panel are never written
+
+def test_unchanged_power_does_not_wake_the_renderer(panel, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(main, 'render_event', asyncio.Event())
+        renderer = asyncio.create_task(main.output_values())
+        woken = []
+        for batcap in (100, 100, 100, 99, 99, 99):
+            panel.send(True, batcap)
+            await main.check_power()
+            woken.append(main.render_event.is_set())
+            await asyncio.sleep(0) #Lets output_values draw
+        renderer.cancel()
+        return woken
+    woken = asyncio.run(scenario())
+    assert woken == [True, False, False, True, False, False]
+    assert main.shown_lines == ['PWR Status: Good', 'Battery: 99%']
+
+def test_values_off_screen_do_not_wake_the_renderer(panel, monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(main, 'render_event', asyncio.Event())
+        main.state.screen = 0 #Temperature screen, which doesn't show the battery
+        monkeypatch.setattr(main, 'shown_lines', main.screen_lines())
+        panel.send(False, 50)
+        await main.check_power()
+        return main.render_event.is_set()
+    assert not asyncio.run(scenario())
+    assert main.state.bat_cap == 50
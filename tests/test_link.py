@@ -0,0 +1,130 @@
+#Runs the link manager against a fake /sys/class/net directory, with fake pon and poff scripts that add and remove ppp0 in it
+
+import asyncio
+
+import pytest
+
+import devices
+import main
+
+@pytest.fixture
+def net(tmp_path):
+    net = tmp_path / 'net'
+    net.mkdir()
+    return net
+
+def script(tmp_path, name, body): #Writes a shell script that logs its name to calls before running body. Returns the command to run it
+    path = tmp_path / (name + '.sh')
+    path.write_text('echo ' + name + ' >> ' + str(tmp_path / 'calls') + '\n' + body + '\n')
+    return 'sh ' + str(path)
+
+def calls(tmp_path): #Names of the fake commands run so far
+    path = tmp_path / 'calls'
+    return path.read_text().split() if path.exists() else []
+
+def link(tmp_path, net, pon_body=None, up_timeout=2, idle_timeout=0.1):
+    if pon_body == None: #Like pppd, ppp0 shows up a little after pon returns
+        pon_body = '(sleep 0.2; mkdir -p ' + str(net / 'ppp0') + '; echo unknown > ' + str(net / 'ppp0' / 'operstate') + ') &'
+    pon = script(tmp_path, 'pon', pon_body)
+    poff = script(tmp_path, 'poff', 'rm -rf ' + str(net / 'ppp0'))
+    return main.LinkManager(str(net), pon, poff, up_timeout, idle_timeout, False)
+
+def test_acquire_waits_for_ppp0(tmp_path, net):
+    manager = link(tmp_path, net)
+    assert not manager.is_up()
+    assert asyncio.run(manager.acquire())
+    assert manager.is_up()
+    assert manager.bring_ups == 1
+    assert manager.last_bring_up >= 0.2
+
+def test_leases_share_one_bring_up(tmp_path, net):
+    manager = link(tmp_path, net)
+    async def scenario():
+        return await asyncio.gather(manager.acquire(), manager.acquire(), manager.acquire())
+
+    assert asyncio.run(scenario()) == [True, True, True]
+    assert calls(tmp_path) == ['pon']
+    assert manager.leases == 3
+
+def test_link_goes_down_after_the_idle_timeout(tmp_path, net):
+    manager = link(tmp_path, net)
+    async def scenario():
+        await manager.acquire()
+        await manager.acquire()
+        manager.release()
+        await asyncio.sleep(0.2)
+        assert manager.is_up() #One lease is still held
+        manager.release()
+        await asyncio.sleep(0.3)
+
+    asyncio.run(scenario())
+    assert calls(tmp_path) == ['pon', 'poff']
+    assert not manager.is_up()
+    assert manager.sessions == 1
+    assert manager.average_session() > 0
+
+def test_new_lease_cancels_the_idle_teardown(tmp_path, net):
+    manager = link(tmp_path, net)
+    async def scenario():
+        await manager.acquire()
+        manager.release()
+        await asyncio.sleep(0.05)
+        assert await manager.acquire() #Still up, so no second bring up
+        await asyncio.sleep(0.2)
+
+    asyncio.run(scenario())
+    assert calls(tmp_path) == ['pon']
+    assert manager.is_up()
+
+def test_connection_brought_up_elsewhere_is_left_up(tmp_path, net):
+    (net / 'ppp0').mkdir()
+    (net / 'ppp0' / 'operstate').write_text('unknown\n')
+    manager = link(tmp_path, net)
+    async def scenario():
+        assert await manager.acquire()
+        manager.release()
+        await asyncio.sleep(0.2)
+
+    asyncio.run(scenario())
+    assert calls(tmp_path) == []
+    assert manager.is_up()
+
+def test_ppp0_that_never_comes_up_times_out(tmp_path, net):
+    manager = link(tmp_path, net, pon_body='true', up_timeout=0.6)
+    async def scenario():
+        assert not await manager.acquire()
+        manager.release()
+        await asyncio.sleep(0.2)
+
+    asyncio.run(scenario())
+    assert calls(tmp_path) == ['pon', 'poff'] #pppd may still be running, so poff is run anyway
+
+def test_missing_pon_fails_the_acquire(tmp_path, net, capsys):
+    manager = main.LinkManager(str(net), str(tmp_path / 'missing_pon'), 'true', 1, 0.1, False)
+    assert not asyncio.run(manager.acquire())
+    assert 'Could not run' in capsys.readouterr().out
+    assert not manager.started
+
+def test_dispatcher_sends_anyway_when_pon_is_missing(tmp_path, net, monkeypatch):
+    sms = devices.FakeSMS()
+    monkeypatch.setattr(main, 'hw', devices.Devices(None, None, None, None, sms))
+    monkeypatch.setattr(main, 'link_manager', main.LinkManager(str(net), str(tmp_path / 'missing_pon'), 'true', 1, 0.1, False))
+    monkeypatch.setattr(main, 'alert_list', ['+15550000001'])
+    monkeypatch.setattr(main, 'debug', False)
+    monkeypatch.setattr(main, 'state', main.MonitorState())
+    main.state.conn = 0 #Internet down, so the dispatcher takes a lease on the SIM connection
+    async def scenario():
+        queue = main.AlertQueue(str(tmp_path / 'alert_journal.json'), 5)
+        monkeypatch.setattr(main, 'alert_queue', queue)
+        queue.put('first')
+        queue.put('second')
+        task = asyncio.create_task(main.dispatch_alerts())
+        await asyncio.sleep(0.2)
+        assert not task.done()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert queue.delivered == 2
+    assert [body for time, to, body in sms.sent] == ['first', 'second']
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import tracemalloc
+
+import metrics
+
+families = [('monitor_up', 'gauge', 'Whether the monitor is up', [({}, True)]),
+            ('probe_rtt_seconds', 'gauge', 'Round trip time', [({'target' : '8.8.8.8:53'}, 0.025), ({'target' : 'a"b\\c\nd'}, float('inf'))]),
+            ('alerts_total', 'counter', 'Alerts sent', [({}, 3)])]
+
+def test_text_format():
+    text = metrics.to_text(families)
+    assert text == ('# HELP monitor_up Whether the monitor is up\n'
+                    '# TYPE monitor_up gauge\n'
+                    'monitor_up 1\n'
+                    '# HELP probe_rtt_seconds Round trip time\n'
+                    '# TYPE probe_rtt_seconds gauge\n'
+                    'probe_rtt_seconds{target="8.8.8.8:53"} 0.025\n'
+                    'probe_rtt_seconds{target="a\\"b\\\\c\\nd"} +Inf\n'
+                    '# HELP alerts_total Alerts sent\n'
+                    '# TYPE alerts_total counter\n'
+                    'alerts_total 3\n')
+
+def test_value_formats():
+    assert [metrics.format_value(value) for value in (False, 7, 2.5, 1e-07, float('-inf'))] == ['0', '7', '2.5', '1e-07', '-Inf']
+
+def test_json_format():
+    result = json.loads(metrics.to_json(families))
+    assert result['monitor_up'] == True
+    assert result['alerts_total'] == 3
+    assert result['probe_rtt_seconds'][0] == {'target' : '8.8.8.8:53', 'value' : 0.025} #Metrics with labels are a list
+    assert result['probe_rtt_seconds'][1]['target'] == 'a"b\\c\nd'
+
+def request(server, data): #Sends raw request bytes to the server and returns everything it answers with
+    async def scenario():
+        await server.start('127.0.0.1', 0)
+        port = server.server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(data)
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return response
+        finally:
+            await server.stop()
+    return asyncio.run(scenario())
+
+def get(server, path):
+    response = request(server, b'GET ' + path.encode('ascii') + b' HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    head, body = response.split(b'\r\n\r\n', 1)
+    head = head.decode('ascii').split('\r\n')
+    assert int([line for line in head if line.startswith('Content-Length: ')][0].split(' ')[1]) == len(body)
+    return head[0], dict(line.split(': ', 1) for line in head[1:]), body.decode('utf-8')
+
+def serve(profiler=None):
+    return metrics.MetricsServer(lambda: families, profiler or metrics.SamplingProfiler(0.01))
+
+def test_metrics_endpoint():
+    server = serve()
+    status, headers, body = get(server, '/metrics')
+    assert status == 'HTTP/1.0 200 OK'
+    assert headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert body == metrics.to_text(families)
+    assert server.scrapes == 1
+
+def test_json_endpoint():
+    status, headers, body = get(serve(), '/metrics?format=json')
+    assert status == 'HTTP/1.0 200 OK'
+    assert headers['Content-Type'] == 'application/json'
+    assert json.loads(body)['alerts_total'] == 3
+
+def test_profile_endpoint():
+    profiler = metrics.SamplingProfiler(0.01)
+    status, headers, body = get(serve(profiler), '/profile')
+    assert status == 'HTTP/1.0 404 Not Found' #Off unless profile_interval is set
+    assert 'profile_interval' in body
+    profiler.stacks['main.py:main;main.py:run_every'] = 5
+    profiler.stacks['main.py:main;main.py:output_values'] = 2
+    profiler.running = True #As if start() had been called, without setting a timer in the test
+    status, headers, body = get(serve(profiler), '/profile')
+    assert status == 'HTTP/1.0 200 OK'
+    assert body == 'main.py:main;main.py:run_every 5\nmain.py:main;main.py:output_values 2\n'
+
+def test_unknown_path_and_method():
+    assert get(serve(), '/')[0] == 'HTTP/1.0 404 Not Found'
+    response = request(serve(), b'POST /metrics HTTP/1.1\r\n\r\n')
+    assert response.startswith(b'HTTP/1.0 405 Method Not Allowed\r\n')
+
+def test_garbage_request_is_dropped():
+    server = serve()
+    assert request(server, b'\xff\xfe\r\n\r\n') == b''
+    assert request(server, b'NONSENSE\r\n\r\n') == b''
+    assert server.scrapes == 0
+
+def test_recording_a_tick_does_not_allocate():
+    stats = metrics.TickStats()
+    workers = [stats.add(name, 1.0) for name in ('update_values', 'check_conn', 'check_power')]
+    stats.record(workers[0], 0.001, 0.0, 1.0) #Warms up the code path
+    tracemalloc.start()
+    try:
+        for tick in range(1000):
+            stats.record(workers[tick % 3], 0.002, 0.0005, 1.0)
+        after_1000 = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        for tick in range(10000):
+            stats.record(workers[tick % 3], 0.002, 0.0005, 1.0)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert current == after_1000 #10000 more ticks kept nothing
+    assert peak - after_1000 < 256 #Only the float temporaries of a single tick, not one per tick
+    assert stats.value(workers[1], 'ticks') == 3333 + 333
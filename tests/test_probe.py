@@ -0,0 +1,74 @@
+#Probes local listener sockets, so the tests don't need the internet
+
+import asyncio
+import socket
+
+import main
+
+async def listener(): #Local server that accepts connections and closes them. Returns (server, target)
+    server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+    return server, ('127.0.0.1', server.sockets[0].getsockname()[1])
+
+def closed_target(): #Port nothing listens on, so connecting is refused right away
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return ('127.0.0.1', sock.getsockname()[1])
+
+def probe(targets, quorum=1, timeout=1, degraded_rtt=500, listeners=0): #Opens listeners for the first few targets and probes every target once
+    async def scenario():
+        servers = []
+        opened = []
+        for index in range(listeners):
+            server, target = await listener()
+            servers.append(server)
+            opened.append(target)
+        prober = main.ConnProber(opened + targets, quorum, timeout, degraded_rtt, 10)
+        status = await prober.probe()
+        for server in servers:
+            server.close()
+        return prober, status
+    return asyncio.run(scenario())
+
+def test_every_target_up_is_connected():
+    prober, status = probe([], listeners=2)
+    assert status == 'connected'
+    assert all(window[-1] != None for window in prober.rtts.values())
+    assert prober.probes == 1
+
+def test_below_quorum_is_disconnected():
+    prober, status = probe([closed_target(), closed_target()], quorum=2, listeners=1)
+    assert status == 'disconnected'
+
+def test_failed_target_above_quorum_is_degraded():
+    prober, status = probe([closed_target()], quorum=1, listeners=1)
+    assert status == 'degraded'
+    assert [window[-1] == None for window in prober.rtts.values()] == [False, True]
+
+def test_slow_round_trip_is_degraded():
+    prober, status = probe([], degraded_rtt=0.0001, listeners=2) #Anything slower than 0.1 us counts as slow
+    assert status == 'degraded'
+    assert prober.average_rtt() > 0
+
+def test_target_that_never_answers_times_out(monkeypatch):
+    open_connection = asyncio.open_connection
+    async def hanging_open_connection(host, port): #Stands in for a target that drops the SYN, which can't be set up on localhost
+        if host == 'blackhole.invalid':
+            await asyncio.sleep(60)
+        return await open_connection(host, port)
+    monkeypatch.setattr(asyncio, 'open_connection', hanging_open_connection)
+
+    prober, status = probe([('blackhole.invalid', 53)], quorum=2, timeout=0.1, listeners=1)
+    assert status == 'disconnected'
+    assert prober.rtts[('blackhole.invalid', 53)][-1] == None
+
+def test_rtt_window_is_bounded():
+    async def scenario():
+        server, target = await listener()
+        prober = main.ConnProber([target], 1, 1, 500, 3)
+        for cycle in range(5):
+            await prober.probe()
+        server.close()
+        return prober, target
+    prober, target = asyncio.run(scenario())
+    assert len(prober.rtts[target]) == 3
+    assert prober.average_cost() > 0
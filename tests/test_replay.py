@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import csv
+
+import metrics
+import main
+import replay
+
+def test_fast_forward_loop_skips_sleeps():
+    loop = replay.FastForwardLoop()
+    try:
+        start = loop.time()
+        loop.run_until_complete(asyncio.sleep(3600))
+        assert loop.time() - start >= 3600
+        assert loop.fast_forward.skipped >= 3599
+    finally:
+        loop.close()
+
+def test_failing_conditions():
+    row = {'seconds' : 0, 'temp_f' : 80.0, 'humid' : 50.0, 'vin_good' : 0, 'batcap' : 90, 'conn' : 'degraded'}
+    assert replay.failing_conditions(row) == {'temp', 'power'} #Degraded is still connected
+    row.update(temp_f=68.0, humid=65.0, vin_good=1, conn='disconnected')
+    assert replay.failing_conditions(row) == {'humid', 'internet'}
+
+def test_alert_latencies():
+    onsets = [[0, 'temp', 1000],
+              [1100, 'temp', 2000], #Back within minute_interval of clearing, so the same episode
+              [5000, 'power', 5010], #Cleared before it could be alerted on
+              [6000, 'internet', None]] #Still going at the end of the trace
+    sent = [(60, '+15550000001', 'temp'), (1200, '+15550000001', 'temp'), (6030, '+15550000001', 'internet')]
+    assert replay.alert_latencies(onsets, sent) == [60, 30]
+
+def write_trace(path): #Three hours with the room heating up for half an hour, then a power outage that takes the internet with it
+    with open(path, 'w', newline='') as trace_file:
+        writer = csv.DictWriter(trace_file, ['seconds', 'temp_f', 'humid', 'vin_good', 'batcap', 'conn'])
+        writer.writeheader()
+        for seconds in range(0, 3 * 3600, 10):
+            minute = seconds / 60
+            hot = 30 <= minute < 60
+            outage = 120 <= minute < 140
+            writer.writerow({'seconds' : seconds, 'temp_f' : 80.0 if hot else 68.0, 'humid' : 45.0, 'vin_good' : int(not outage),
+                             'batcap' : 80 if outage else 100, 'conn' : 'disconnected' if outage else 'connected'})
+
+def test_replay_smoke(tmp_path, monkeypatch, capsys):
+    for name in ('history_file', 'alert_journal', 'debug', 'metrics_port', 'profile_interval', 'profiler', 'executor', 'link_manager', 'conn_prober', 'wall_clock_offset',
+                 'hw', 'dht_sampler', 'lcd_renderer', 'history', 'alert_queue', 'render_event', 'shown_lines'): #Everything run() and setup() replace
+        monkeypatch.setattr(main, name, getattr(main, name))
+    monkeypatch.setattr(main.metrics_server, 'profiler', main.metrics_server.profiler)
+    monkeypatch.setattr(main, 'state', main.MonitorState()) #Starts from a clean monitor, whatever other tests left behind
+    monkeypatch.setattr(main, 'rule_engine', main.load_rules(main.config))
+    monkeypatch.setattr(main, 'alert_digest', main.AlertDigest(main.alert_digest_window))
+    monkeypatch.setattr(main, 'ups_parser', main.UPSParser(main.ups_history))
+    monkeypatch.setattr(main, 'tick_stats', metrics.TickStats())
+    trace = tmp_path / 'trace.csv'
+    write_trace(trace)
+    replay.run(argparse.Namespace(trace=str(trace), days=None, step=None, seed=1, dht_fail_rate=0.0, save=None, profile=0, verbose=True))
+    output = capsys.readouterr().out
+    assert 'Replayed 3.0 h' in output
+    assert 'Conditions: 3 |' in output #Temperature, then power and internet together
+    assert 'Room temperature is too hot' in output
+    assert 'External power unavailable.\nServer Monitor UPS Capacity: 80%' in output
+    assert 'Internet connection status:\nDisconnected' in output
+    latencies = output.split('Alert latency: average ')[1]
+    assert float(latencies.split(' s | max ')[1].split(' s')[0]) < 120
@@ -0,0 +1,99 @@
+import asyncio
+import configparser
+
+import pytest
+
+import main
+
+def engine(*sections): #RuleEngine from rule sections written like setup.conf, each a (name, options) pair
+    config = configparser.ConfigParser(interpolation=None)
+    for name, options in sections:
+        config['rule ' + name] = options
+    return main.load_rules(config)
+
+def snapshot(**values): #State values with the defaults, changed by values
+    state = main.MonitorState()
+    for name, value in values.items():
+        setattr(state, name, value)
+    return vars(state)
+
+def test_range_with_hysteresis():
+    rules = engine(('temp', {'metric' : 'temp', 'condition' : 'range', 'low' : '50', 'high' : '75', 'hysteresis' : '1'}))
+    results = [rules.evaluate(snapshot(temp=temp), 0)[0] for temp in (70, 75.5, 74.5, 73.9, 49, 50.5, 51)]
+    assert results == [False, True, True, False, True, True, False] #Has to come 1 degree back inside the range to pass again
+
+def test_message_inside_the_hysteresis_band(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'history', main.HistoryStore(str(tmp_path / 'history.bin'), 10, 10, 10)) #Empty, for temp_rate
+    monkeypatch.setattr(main, 'now', lambda: 0)
+    rules = main.load_rules(main.config) #The shipped rules
+    rule = rules.by_name['temp']
+    assert rules.evaluate(snapshot(temp=76.0), 0)[0]
+    assert rule.build_message(snapshot(temp=76.0)).startswith('Room temperature is too hot')
+    assert rules.evaluate(snapshot(temp=74.8), 0)[0] #Back inside the range, but not by hysteresis yet
+    assert rule.build_message(snapshot(temp=74.8)) == 'Room temperature is too hot.\nCurrent Temperature: 74.8 F'
+    assert rules.evaluate(snapshot(temp=52.0), 0)[0]
+    assert rules.evaluate(snapshot(temp=53.2), 0)[0]
+    assert rule.build_message(snapshot(temp=53.2)).startswith('Room temperature is too cold')
+
+def test_bool():
+    rules = engine(('power', {'metric' : 'pwr_status', 'condition' : 'bool', 'placeholder' : 'bat_cap'}))
+    assert rules.evaluate(snapshot(pwr_status=1), 0) == [False]
+    assert rules.evaluate(snapshot(pwr_status=0), 0) == [True]
+
+def test_rate_reads_the_history(tmp_path, monkeypatch):
+    history = main.HistoryStore(str(tmp_path / 'history.bin'), 100, 10, 10)
+    monkeypatch.setattr(main, 'history', history)
+    rules = engine(('temp_rate', {'metric' : 'temp', 'condition' : 'rate', 'max_change' : '5', 'window' : '600'}))
+    for index, temp in enumerate((70, 71, 72, 74, 76)):
+        history.append(1000 + index * 150, [temp, 50, 100, 1, 1])
+    monkeypatch.setattr(main, 'now', lambda: 1600)
+    assert rules.evaluate(snapshot(), 1600) == [True] #6 degrees in 10 minutes
+    monkeypatch.setattr(main, 'now', lambda: 1750)
+    assert rules.evaluate(snapshot(), 1750) == [False] #5 degrees over the last 10 minutes
+
+def test_sustain():
+    rules = engine(('internet', {'metric' : 'conn', 'condition' : 'bool', 'sustain' : '60'}))
+    assert [rules.evaluate(snapshot(conn=0), time)[0] for time in (0, 30, 59, 60, 120)] == [False, False, False, True, True]
+    assert rules.evaluate(snapshot(conn=1), 125) == [False]
+    assert rules.evaluate(snapshot(conn=0), 130) == [False] #Starts over once it passes
+
+@pytest.mark.parametrize('options, error', [
+    ({'metric' : 'temp', 'condition' : 'between'}, 'unknown condition between'),
+    ({'metric' : 'temperature', 'condition' : 'range'}, 'unknown metric temperature'),
+    ({'condition' : 'bool'}, 'unknown metric None'),
+    ({'metric' : 'pwr_status', 'condition' : 'bool', 'placeholder' : 'battery'}, 'unknown placeholder battery'),
+    ({'metric' : 'conn_status', 'condition' : 'range', 'low' : '0', 'high' : '1'}, 'unknown metric conn_status'), #A state value, but a string
+    ({'metric' : 'display', 'condition' : 'bool'}, 'unknown metric display'),
+    ({'metric' : 'temp', 'condition' : 'range', 'placeholder' : 'screen'}, 'unknown placeholder screen')])
+def test_bad_rules_fail_when_read(options, error):
+    with pytest.raises(ValueError, match=error):
+        engine(('bad', options))
+
+class DigestRecorder: #Stands in for the alert digest. Records which checks added an alert
+    def __init__(self):
+        self.check = 0
+        self.added = []
+
+    def failing(self, name):
+        pass
+
+    def passing(self, name):
+        pass
+
+    def add(self, name):
+        self.added.append(self.check)
+
+def test_alerts_on_the_check_after_alert_after_failures(monkeypatch):
+    digest = DigestRecorder()
+    monkeypatch.setattr(main, 'alert_digest', digest)
+    monkeypatch.setattr(main, 'rule_engine', engine(('internet', {'metric' : 'conn', 'condition' : 'bool'})))
+    monkeypatch.setattr(main, 'state', main.MonitorState())
+    main.state.conn = 0
+    checks_between = 60 // main.monitor_interval * main.minute_interval #minute_interval in checks
+    async def scenario():
+        for check in range(2 * checks_between + main.alert_after_failures + 1):
+            digest.check = check
+            await main.monitor_values()
+    asyncio.run(scenario())
+    first = main.alert_after_failures #Fails alert_after_failures checks, then alerts on the next one
+    assert digest.added == [first, first + checks_between, first + 2 * checks_between]
@@ -0,0 +1,39 @@
+import asyncio
+
+import main
+
+async def run_for(seconds, coroutine): #Runs a task that never ends by itself for a while, then cancels it
+    task = asyncio.create_task(coroutine)
+    await asyncio.sleep(seconds)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    return task
+
+def test_run_every_keeps_running_after_a_tick_fails(capsys):
+    ticks = []
+    async def failing_first_tick():
+        ticks.append(len(ticks))
+        if len(ticks) == 1:
+            raise ValueError('first tick fails')
+
+    asyncio.run(run_for(0.1, main.run_every(0.01, failing_first_tick)))
+    assert len(ticks) > 2
+    assert 'Error in failing_first_tick' in capsys.readouterr().out
+
+def test_run_every_does_not_drift():
+    ticks = []
+    async def counting_tick():
+        ticks.append(asyncio.get_running_loop().time())
+        await asyncio.sleep(0.005) #Part of every interval is spent in the tick
+
+    asyncio.run(run_for(0.205, main.run_every(0.02, counting_tick)))
+    assert 10 <= len(ticks) <= 12 #Scheduled from the start of each tick, so the time in the tick doesn't add up
+
+def test_run_every_records_overruns():
+    async def slow_tick():
+        await asyncio.sleep(0.03)
+
+    asyncio.run(run_for(0.1, main.run_every(0.01, slow_tick)))
+    worker = main.tick_stats.names.index('slow_tick')
+    assert main.tick_stats.value(worker, 'overruns') >= 2
+    assert main.tick_stats.value(worker, 'max_seconds') >= 0.03
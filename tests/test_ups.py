@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import devices
+import main
+
+def feed(parser, *chunks): #Feeds chunks to the parser inside a loop, since frames are timestamped with the loop clock
+    async def scenario():
+        for chunk in chunks:
+            parser.feed(chunk)
+    asyncio.run(scenario())
+    return parser
+
+def test_frame_fields_are_typed():
+    parser = feed(main.UPSParser(5), devices.ups_frame(True, 87, 5180))
+    assert parser.latest == {'version' : 'SmartUPS V3.2P', 'Vin' : 'GOOD', 'BATCAP' : 87, 'Vout' : 5180}
+    assert parser.frames == 1
+
+def test_frame_split_across_reads():
+    frame = devices.ups_frame(False, 60)
+    parser = feed(main.UPSParser(5), frame[:7], frame[7:30], frame[30:])
+    assert parser.latest['Vin'] == 'NG'
+    assert parser.latest['BATCAP'] == 60
+    assert parser.frames == 1
+    assert len(parser.buffer) == 0
+
+def test_garbage_frame_is_counted_and_skipped():
+    parser = feed(main.UPSParser(5), b'$ SmartUPS V3.2P,Vin GO\x00\xff,BATC\n' + b'\n' + devices.ups_frame(True, 99) + b'$ SmartUPS,Vin GOOD,BATCAP lots $\n')
+    assert parser.frame_errors == 2
+    assert parser.frames == 1
+    assert parser.latest['BATCAP'] == 99
+
+def test_overlong_line_is_thrown_away():
+    parser = feed(main.UPSParser(5), b'x' * (main.UPSParser.max_frame + 1), devices.ups_frame(True, 75))
+    assert parser.frame_errors == 1
+    assert parser.latest['BATCAP'] == 75 #The buffer was cleared, so the next frame parses
+
+def test_only_the_newest_frame_is_acted_on(monkeypatch):
+    ups = devices.FakeUPS()
+    monkeypatch.setattr(main, 'hw', devices.Devices(None, None, None, ups, None))
+    monkeypatch.setattr(main, 'ups_parser', main.UPSParser(5))
+    monkeypatch.setattr(main, 'state', main.MonitorState())
+    for vin_good, batcap in ((False, 90), (False, 85), (True, 80)):
+        ups.send(vin_good, batcap)
+    async def scenario():
+        monkeypatch.setattr(main, 'render_event', asyncio.Event())
+        await main.check_power()
+    asyncio.run(scenario())
+    assert main.state.pwr_status == 1
+    assert main.state.bat_cap == 80
+    assert [frame['BATCAP'] for frame in main.ups_parser.history] == [90, 85]
+    assert ups.in_waiting == 0 #Drained everything in one check
+
+def test_check_power_reads_a_pty_ups(monkeypatch):
+    serial = pytest.importorskip('serial')
+    ups = devices.PtyUPS()
+    port = serial.Serial(ups.port, 9600, timeout=0)
+    monkeypatch.setattr(main, 'hw', devices.Devices(None, None, None, port, None))
+    monkeypatch.setattr(main, 'ups_parser', main.UPSParser(5))
+    monkeypatch.setattr(main, 'state', main.MonitorState())
+    async def scenario():
+        monkeypatch.setattr(main, 'render_event', asyncio.Event())
+        ups.send(True, 100)
+        frame = devices.ups_frame(False, 42)
+        ups.write(frame[:10])
+        await asyncio.sleep(0.05)
+        await main.check_power() #Only half of the second frame has arrived
+        assert main.state.bat_cap == 100
+        ups.write(frame[10:])
+        await asyncio.sleep(0.05)
+        await main.check_power()
+    try:
+        asyncio.run(scenario())
+    finally:
+        port.close()
+        ups.close()
+    assert main.state.pwr_status == 0
+    assert main.state.bat_cap == 42